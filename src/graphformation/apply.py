@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""Apply
+
+In this module we apply a saved plan to the environment.
+Applying a plan does not need the program which produced it.
+"""
+
+import subprocess
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from graphformation import checkpoint
+from graphformation import plan as gf_plan
+from graphformation import ratelimit
+from graphformation import state_store
+
+
+def run_shell(command):
+    """
+    Runs a single command of an operation
+    :param command: a shell command
+    :return: None
+    """
+    subprocess.run(command, shell=True, check=True)
+
+
+def verify_state(plan, filename):
+    """
+    raises an exception if the state is not the one the plan was computed against
+    :param plan: the plan to apply
+    :param filename: the filename where the state is stored
+    :return: a tuple of the current state and its generation
+    """
+    state, generation = state_store.read(filename)
+    current_hashes = gf_plan.state_hashes(state)
+    if current_hashes != plan.state_hashes:
+        changed = set(current_hashes.items()).symmetric_difference(plan.state_hashes.items())
+        changed_ids = sorted(set(key for key, _ in changed))
+        raise Exception(("The state in {filename} has changed since the plan was created "
+                         "(resources: {resource_ids}). Create a new plan.").
+                        format(filename=filename, resource_ids=", ".join(changed_ids)))
+    return state, generation
+
+
+def _run_operation(operation, run_command, limiter, retries, backoff):
+    resource_type = operation["resource_type"]
+    for attempt in range(retries + 1):
+        limiter.acquire(resource_type)
+        start = time.monotonic()
+        try:
+            for command in operation["commands"]:
+                run_command(command)
+        except Exception: # pylint: disable=W0703
+            limiter.release(resource_type, False, time.monotonic() - start)
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+            continue
+        limiter.release(resource_type, True, time.monotonic() - start)
+        return
+
+
+def _apply_sequential(plan, done, journal, run):
+    for index, operation in enumerate(plan.operations):
+        if index in done:
+            continue
+        run(operation)
+        journal.record(index)
+
+
+class _Schedule:
+    """
+    _Schedule hands out the operations of a plan once the operations they depend on are completed.
+    Creates and updates also wait for all deletes, as a sequential apply runs them: a delete and
+    a create of the same path have no dependency between them when the resource id changed
+    """
+    def __init__(self, plan, done):
+        self.operations = plan.operations
+        self._remaining = {}
+        self._dependents = {}
+        for j, deps in plan.dependencies().items():
+            if j in done:
+                continue
+            self._remaining[j] = set(deps).difference(done)
+            for i in self._remaining[j]:
+                self._dependents.setdefault(i, []).append(j)
+        self._deletes = {j for j in self._remaining if self.operations[j]["op_type"] == "delete"}
+        self._ready = []
+        self._held = []
+        for j in sorted(j for j, deps in self._remaining.items() if not deps):
+            self._release(j)
+
+    def _release(self, j):
+        if self._deletes and self.operations[j]["op_type"] != "delete":
+            self._held.append(j)
+        else:
+            self._ready.append(j)
+
+    def next(self):
+        """
+        :return: the index of an operation which can be started, None if there is none
+        """
+        return self._ready.pop(0) if self._ready else None
+
+    def completed(self, j):
+        """
+        Marks an operation as completed and releases the operations waiting for it
+        :param j: the index of the operation
+        :return: None
+        """
+        self._deletes.discard(j)
+        for k in self._dependents.get(j, []):
+            self._remaining[k].discard(j)
+            if not self._remaining[k]:
+                self._release(k)
+        if not self._deletes and self._held:
+            self._ready.extend(sorted(self._held))
+            self._held = []
+
+
+def _apply_parallel(plan, done, journal, run, workers):
+    schedule = _Schedule(plan, done)
+    failure = None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        running = {}
+        while True:
+            j = schedule.next() if failure is None else None
+            while j is not None:
+                running[pool.submit(run, plan.operations[j])] = j
+                j = schedule.next()
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                j = running.pop(future)
+                try:
+                    future.result()
+                except Exception as e: # pylint: disable=W0703
+                    failure = failure or e
+                    continue
+                journal.record(j)
+                schedule.completed(j)
+    if failure is not None:
+        raise failure
+
+
+def apply_plan(plan, filename, run_command=run_shell, checkpoint_batch_size=64, history=None, # pylint: disable=R0913
+               workers=1, limiter=None, retries=0, backoff=0.5):
+    """
+    Applies a plan and stores the new state.
+    Completed operations are checkpointed, so if applying fails, running
+    it again with the same plan resumes from the first unfinished operation
+    :param plan: a Plan, usually loaded from a plan file
+    :param filename: the filename where the state is stored
+    :param run_command: a function which runs a single command
+    :param checkpoint_batch_size: how many completed operations are committed together
+    :param history: an optional History in which the new state is saved as a new version
+    :param workers: how many operations are applied in parallel, respecting their dependencies
+    :param limiter: an optional ratelimit.Limiter which limits the operations per resource type
+    :param retries: how many times a failed operation is retried
+    :param backoff: the wait in seconds before the first retry. It doubles with each retry
+    :return: the new state
+    """
+    base_state, generation = verify_state(plan, filename)
+    # a concurrent run has to fail before the environment is changed, not after
+    state_store.reserve(filename, base_state, generation, plan.new_state, plan.fingerprint())
+    journal = checkpoint.Journal(filename + ".journal", plan.fingerprint(),
+                                 batch_size=checkpoint_batch_size)
+    done = journal.completed()
+    if done:
+        print("Resuming: {done} of {total} operations have already been applied".
+              format(done=len(done), total=len(plan.operations)))
+
+    limiter = limiter or ratelimit.UNLIMITED
+    def run(operation):
+        _run_operation(operation, run_command, limiter, retries, backoff)
+
+    try:
+        if workers > 1:
+            _apply_parallel(plan, done, journal, run, workers)
+        else:
+            _apply_sequential(plan, done, journal, run)
+    finally:
+        journal.close()
+
+    new_state, _ = state_store.commit(filename, base_state, generation, plan.new_state,
+                                      owner=plan.fingerprint(),
+                                      on_commit=state_store.index_and_history(filename, history))
+    journal.remove()
+    return new_state
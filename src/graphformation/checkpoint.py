@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Checkpoint
+
+In this module we record the progress of applying a plan.
+Completed operations are appended to a journal file next to the state file.
+The journal is flushed to disk in batches (group commit), so a crash loses
+at most the last uncommitted batch, which is then simply re-applied.
+"""
+
+import json
+import os
+import time
+
+
+class Journal:
+    """
+    Journal is an append only log of the indices of completed operations of one plan
+    """
+    def __init__(self, filename, plan_id, batch_size=64, interval=1.0):
+        self.filename = filename
+        self.plan_id = plan_id
+        self.batch_size = batch_size
+        self.interval = interval
+        self._pending = []
+        self._last_commit = time.monotonic()
+        self._file = None
+
+    def completed(self):
+        """
+        Reads the journal. A journal which belongs to another plan is discarded
+        :return: the set of indices of operations completed by a previous run
+        """
+        done = set()
+        if os.path.isfile(self.filename):
+            with open(self.filename, 'rb') as f:
+                content = f.read()
+            # only lines which end in a newline are complete, the last one
+            # is torn if we crashed in the middle of a write
+            complete = content[:content.rfind(b"\n") + 1]
+            lines = complete.decode("ascii", errors="replace").split("\n")[:-1]
+            try:
+                header = json.loads(lines[0]) if lines else {}
+            except ValueError:
+                header = {}
+            if header.get("plan") == self.plan_id:
+                for line in lines[1:]:
+                    if line.isdigit():
+                        done.add(int(line))
+                # the torn line is cut off, so the next record starts on a line of its own
+                os.truncate(self.filename, len(complete))
+                self._file = open(self.filename, 'a')
+                return done
+
+        self._file = open(self.filename, 'w')
+        self._file.write(json.dumps({"plan": self.plan_id}) + "\n")
+        self._sync()
+        return done
+
+    def record(self, index):
+        """
+        Marks an operation as completed. The record becomes durable on the next commit
+        :param index: the index of the operation in the plan
+        :return: None
+        """
+        self._pending.append(index)
+        if (len(self._pending) >= self.batch_size or
+                time.monotonic() - self._last_commit >= self.interval):
+            self.commit()
+
+    def commit(self):
+        """
+        Writes all pending records with a single fsync
+        :return: None
+        """
+        if self._pending:
+            self._file.write("".join("{}\n".format(index) for index in self._pending))
+            self._sync()
+            self._pending = []
+        self._last_commit = time.monotonic()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        """
+        Commits the pending records and closes the journal
+        :return: None
+        """
+        if self._file is None:
+            return
+        self.commit()
+        self._file.close()
+        self._file = None
+
+    def remove(self):
+        """
+        Removes the journal once the plan has been fully applied
+        :return: None
+        """
+        self.close()
+        if os.path.isfile(self.filename):
+            os.unlink(self.filename)
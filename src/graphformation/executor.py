@@ -1,14 +1,22 @@
-import json, os
+import base64, io, json, sys, tarfile, zlib
 from graphformation import schema
-from toposort import toposort
+from graphformation import index as gf_index
+from graphformation import plan as gf_plan
+from graphformation import plan_cache as gf_plan_cache
+from graphformation import profiling
 
 
 class OpCtx(object):
-    def __init__(self, op_type, resource, comment=None):
+    def __init__(self, op_type, resources, comment=None):
+        # a batch operation covers several resources of the same type
+        self.op_type = op_type
+        self.resource_type = resources[0]["resource_type"]
+        self.resource_ids = [resource["id"] for resource in resources]
+        self.resource_id = self.resource_ids[0]
         self.comment = "# {op_type} {resource_type} {resource_id}".format(
             op_type = op_type,
-            resource_type=resource["resource_type"],
-            resource_id=resource["id"]
+            resource_type=self.resource_type,
+            resource_id=", ".join(self.resource_ids)
         )
         self.commands = []
 
@@ -22,14 +30,34 @@ class OpCtx(object):
         repr += "\n# end\n\n"
         return repr
 
+    def json_repr(self):
+        return {
+            "op_type": self.op_type,
+            "resource_type": self.resource_type,
+            "resource_id": self.resource_id,
+            "resource_ids": self.resource_ids,
+            "comment": self.comment,
+            "commands": self.commands
+        }
+
 
 class ScriptCtx(object):
-    def __init__(self, repr):
+    def __init__(self, repr, externals=None, old_repr=None):
         self.repr = repr
+        # resources outside of repr which it references, e.g. in other shards
+        self.externals = externals or {}
+        # resources deleted together with the resources which reference them
+        self.old_repr = old_repr or {}
         self.operations = []
+        # resolved references and derived values, computed once per referenced resource
+        self._refs = {}
+        self._path_prefixes = {}
 
     def operation(self, type, resource, comment=None):
-        operation = OpCtx(type, resource, comment=comment)
+        return self.batch_operation(type, [resource], comment=comment)
+
+    def batch_operation(self, type, resources, comment=None):
+        operation = OpCtx(type, resources, comment=comment)
         self.operations.append(operation)
         return operation
 
@@ -37,7 +65,29 @@ class ScriptCtx(object):
         id = ref.get("!ref")
         if id is None:
             raise Exception("Internal error. Expected reference, found {}".format(json.format(ref)))
-        return self.repr[id]
+        resolved = self._refs.get(id)
+        if resolved is None:
+            if id not in self.repr and id in self.externals:
+                resolved = self.externals[id]
+            elif id not in self.repr and id in self.old_repr:
+                resolved = self.old_repr[id]
+            else:
+                resolved = self.repr[id]
+            self._refs[id] = resolved
+        return resolved
+
+    # the same as os.path.join(location, filename) for the location of the referenced
+    # resource, but the location is resolved and normalized once per referenced resource
+    def path(self, ref, filename):
+        id = ref.get("!ref")
+        prefix = self._path_prefixes.get(id)
+        if prefix is None:
+            location = self.get_ref(ref)["properties"]["location"]
+            prefix = location if location == "" or location.endswith("/") else location + "/"
+            self._path_prefixes[id] = prefix
+        if filename.startswith("/"):
+            return filename
+        return prefix + filename
 
     def dump(self):
         r = "\n".join(map(lambda x: x.dump(2), self.operations))
@@ -48,7 +98,105 @@ class ScriptCtx(object):
         return r
 
 
+# a command is run as sh -c COMMAND, a single argument, which Linux limits to
+# 128 KiB (MAX_ARG_STRLEN). batch operations split their commands below that
+MAX_COMMAND_BYTES = 64 * 1024
+
+# the mode of a file created by the shell, before the umask
+_FILE_MODE = 0o666
+
+
+def _bounded_commands(prefix, args, limit=MAX_COMMAND_BYTES):
+    # as few "prefix arg1 arg2 ..." commands as the limit allows
+    commands = []
+    current, size = [], len(prefix.encode("utf-8"))
+    for arg in args:
+        arg_size = 1 + len(arg.encode("utf-8"))
+        if current and size + arg_size > limit:
+            commands.append(" ".join([prefix] + current))
+            current, size = [], len(prefix.encode("utf-8"))
+        current.append(arg)
+        size += arg_size
+    if current:
+        commands.append(" ".join([prefix] + current))
+    return commands
+
+
+def _text_command(text, fullpath):
+    # the quoted delimiter keeps the shell from expanding the text
+    return """cat > {fullpath} << 'ENDOFFILE'
+{text}
+ENDOFFILE
+""".format(text=text, fullpath=fullpath)
+
+
+class _Archive(object):
+    # a gzip compressed tar archive which is built member by member. The compressor is
+    # flushed after every member, so the size of the archive is known after each of them
+    _END = b"\0" * (2 * tarfile.BLOCKSIZE)
+    # the compressed end of the archive and the gzip trailer
+    _END_BYTES = 64
+
+    def __init__(self):
+        self._compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self._chunks = []
+        self.size = 0
+
+    def add(self, name, data, budget):
+        # adds the member unless the archive would exceed the budget, returns whether it did
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        # the mode and time of extraction are left to the shell, like for unbatched
+        # creates: tar is run with --no-same-permissions (umask) and -m (current time)
+        info.mode = _FILE_MODE
+        info.mtime = 0
+        padding = b"\0" * (-len(data) % tarfile.BLOCKSIZE)
+        compressor = self._compressor.copy()
+        chunk = compressor.compress(info.tobuf(tarfile.GNU_FORMAT) + data + padding)
+        chunk += compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self._chunks and self.size + len(chunk) + self._END_BYTES > budget:
+            return False
+        self._compressor = compressor
+        self._chunks.append(chunk)
+        self.size += len(chunk)
+        return True
+
+    def getvalue(self):
+        end = self._compressor.copy()
+        return b"".join(self._chunks) + end.compress(self._END) + end.flush()
+
+
+def _tar_commands(members, dirname, limit=MAX_COMMAND_BYTES):
+    # one extraction per archive whose base64 encoding fits into a command
+    suffix = " | base64 -d | tar -xz -m --no-same-owner --no-same-permissions -C " + dirname
+    budget = (limit - len("echo ") - len(suffix.encode("utf-8"))) * 3 // 4
+    archives = [_Archive()]
+    for name, data in members:
+        if not archives[-1].add(name, data, budget):
+            archives.append(_Archive())
+            archives[-1].add(name, data, budget)
+    return ["echo {archive}{suffix}".format(
+        archive=base64.b64encode(archive.getvalue()).decode("ascii"), suffix=suffix)
+            for archive in archives]
+
+
+def _text_commands(members, dirname):
+    # an archive for the text files of a directory, unless a command per file is smaller
+    if not members:
+        return []
+    prefix = dirname if dirname == "" or dirname.endswith("/") else dirname + "/"
+    commands = [_text_command(text, prefix + name) for name, text in members]
+    archive_commands = _tar_commands([(name, (text + "\n").encode("utf-8"))
+                                      for name, text in members], dirname)
+    if sum(map(len, archive_commands)) < sum(map(len, commands)):
+        return archive_commands
+    return commands
+
+
 class ExecutableResource(object):
+    # A resource type may also define the class methods create_many(ctx, execs)
+    # and delete_many(ctx, execs). The planner then hands it all resources of
+    # the type which share a parent and are created (deleted) in the same wave.
     def __init__(self, resource):
         self.resource=resource
 
@@ -65,7 +213,7 @@ class Directory(ExecutableResource):
     def create(self, ctx):
         op = ctx.operation("create", self.resource)
         props = self.resource["properties"]
-        op.command("mkdir -f {dirname}".format(dirname=props["location"]))
+        op.command("mkdir -p {dirname}".format(dirname=props["location"]))
         self.update_status("created", {})
 
     def requires_recreate(self, ctx, old_resource):
@@ -90,6 +238,24 @@ class Directory(ExecutableResource):
         op.command("rm -fr {dirname}".format(dirname=props["location"]))
         self.update_status("deleted", {})
 
+    @classmethod
+    def create_many(cls, ctx, execs):
+        op = ctx.batch_operation("create", [e.resource for e in execs])
+        dirnames = [e.resource["properties"]["location"] for e in execs]
+        for command in _bounded_commands("mkdir -p", dirnames):
+            op.command(command)
+        for e in execs:
+            e.update_status("created", {})
+
+    @classmethod
+    def delete_many(cls, ctx, execs):
+        op = ctx.batch_operation("delete", [e.resource for e in execs])
+        dirnames = [e.resource["properties"]["location"] for e in execs]
+        for command in _bounded_commands("rm -fr", dirnames):
+            op.command(command)
+        for e in execs:
+            e.update_status("deleted", {})
+
 
 class File(ExecutableResource):
     def __init__(self, resource):
@@ -100,16 +266,12 @@ class File(ExecutableResource):
     def create(self, ctx):
         op = ctx.operation("create", self.resource)
         props = self.resource["properties"]
-        parent = ctx.get_ref(props["parent"])
-        fullpath = os.path.join(parent["properties"]["location"], props["filename"])
+        fullpath = ctx.path(props["parent"], props["filename"])
         cmd = None
         if "text" in props:
-            cmd = """echo << ENDOFFILE
-{text}
-ENDOFFILE > {fullpath}
-""".format(text=props["text"], fullpath=fullpath)
+            cmd = _text_command(props["text"], fullpath)
         if "source" in props:
-            cmd = "wget {source} {fullpath}".format(source=props["source"], fullpath=fullpath)
+            cmd = "wget -O {fullpath} {source}".format(source=props["source"], fullpath=fullpath)
         if cmd is None:
             raise Exception("Internal error in File")
         op.command(cmd)
@@ -124,12 +286,44 @@ ENDOFFILE > {fullpath}
     def delete(self, ctx):
         op = ctx.operation("delete", self.resource)
         props = self.resource["properties"]
-        parent = ctx.get_ref(props["parent"])
-        fullpath = os.path.join(parent["properties"]["location"], props["filename"])
+        fullpath = ctx.path(props["parent"], props["filename"])
         cmd = "rm -f {fullpath}".format(fullpath=fullpath)
         op.command(cmd)
         self.update_status("deleted", {})
 
+    @classmethod
+    def create_many(cls, ctx, execs):
+        # all files share the parent directory
+        op = ctx.batch_operation("create", [e.resource for e in execs])
+        parent_ref = execs[0].resource["properties"]["parent"]
+        location = ctx.get_ref(parent_ref)["properties"]["location"]
+        members = []
+        for e in execs:
+            props = e.resource["properties"]
+            # like an unbatched create, the source wins over the text
+            if "source" in props:
+                op.command("wget -O {fullpath} {source}".format(
+                    source=props["source"], fullpath=ctx.path(parent_ref, props["filename"])))
+            elif props["filename"].startswith("/"):
+                # tar would extract an absolute filename under the directory
+                op.command(_text_command(props["text"], props["filename"]))
+            else:
+                members.append((props["filename"], props["text"]))
+        for command in _text_commands(members, location):
+            op.command(command)
+        for e in execs:
+            e.update_status("created", {})
+
+    @classmethod
+    def delete_many(cls, ctx, execs):
+        op = ctx.batch_operation("delete", [e.resource for e in execs])
+        parent_ref = execs[0].resource["properties"]["parent"]
+        fullpaths = [ctx.path(parent_ref, e.resource["properties"]["filename"]) for e in execs]
+        for command in _bounded_commands("rm -f", fullpaths):
+            op.command(command)
+        for e in execs:
+            e.update_status("deleted", {})
+
 
 class DummyRefResource(ExecutableResource):
     def __init__(self, resource):
@@ -240,60 +434,190 @@ def _diff(ctx, new_state, old_state):
     return {
         "created": inserted,
         "deleted": deleted,
-        "modified": modified
+        "modified": set(modified)
     }
 
 
 # for the modified ones we need to find out which can be modified without destroying them
 def topological_sort(graph):
+    from toposort import toposort
     items = {}
     for key, item in graph.items():
-        sources = []
-        for value in graph[key]['properties'].values():
-            if isinstance(value, dict) and '!ref' in value:
-                ref = value['!ref']
-                sources.append(ref)
-        items[key] = set(sources)
+        items[key] = set(gf_index.references(item))
     return list(toposort(items))
 
 
-def execute(old_state, graph_repr):
-    sorted_new_keys = topological_sort(graph_repr)
-
-    sorted_old_keys = topological_sort(old_state)
-    ctx = ScriptCtx(graph_repr)
-    diff = _diff(ctx, graph_repr, old_state)
-    deleted = 0
-    for key_group in sorted_old_keys[::-1]:
-        for key in key_group:
-            if key in diff['deleted']:
-                repr = old_state[key]
-                exec = from_type(repr["resource_type"])(repr)
-                exec.delete(ctx)
-                deleted += 1
-
-    created = 0
-    for key_group in sorted_new_keys:
-        for key in key_group:
-            if key in diff['created']:
-                repr = graph_repr[key]
-                exec = from_type(repr["resource_type"])(repr)
-                exec.create(ctx)
-                created += 1
-
-    modified = 0
-    for key_group in sorted_new_keys:
-        for key in key_group:
-            if key in diff['modified']:
-                repr = graph_repr[key]
-                exec = from_type(repr["resource_type"])(repr)
-                changed_props = _resource_diff(graph_repr[key], old_state[key])
-                exec.update(ctx, changed_props)
-                modified += 1
-
-    print("{deleted} deleted".format(deleted=deleted))
-    print("{created} created".format(created=created))
-    print("{modified} modified".format(modified=modified))
-
-    return graph_repr, ctx.dump_str()
+def _operation_edges(operations, old_state, graph_repr):
+    # edges (i, j) mean operation i has to finish before operation j starts
+    index = {}
+    for i, op in enumerate(operations):
+        for resource_id in op.resource_ids:
+            index[(op.op_type, resource_id)] = i
+
+    dependents = {}
+    for key, item in old_state.items():
+        for ref in gf_index.references(item):
+            dependents.setdefault(ref, []).append(key)
+
+    edges = set()
+    for j, op in enumerate(operations):
+        for resource_id in op.resource_ids:
+            if op.op_type == "delete":
+                # whatever references the deleted resource goes first
+                for key in dependents.get(resource_id, []):
+                    edges.add((index.get(("delete", key)), j))
+                continue
+            edges.add((index.get(("delete", resource_id)), j))
+            # a created resource only waits for its references to be created
+            ref_op_types = ["create"] if op.op_type == "create" else ["create", "update"]
+            for ref in gf_index.references(graph_repr[resource_id]):
+                for op_type in ref_op_types:
+                    edges.add((index.get((op_type, ref)), j))
+    return sorted((i, j) for i, j in edges if i is not None and i != j)
+
+
+def execute(old_state, graph_repr, plan_cache=None, externals=None, batch=True, profiler=None,
+            with_operations=False):
+    # returns (state, program), and the list of operations as json if with_operations
+    cache_key = None
+    if plan_cache is not None:
+        cache_key = gf_plan_cache.fingerprint(old_state, graph_repr, externals, batch)
+        entry = plan_cache.get(cache_key)
+        if entry is not None:
+            _print_summary(entry["summary"])
+            if with_operations:
+                return entry["state"], entry["program"], entry["operations"]
+            return entry["state"], entry["program"]
+
+    ctx, summary = _plan(old_state, graph_repr, externals, batch, profiler)
+    _print_summary(summary)
+
+    program = ctx.dump_str()
+    operations = [op.json_repr() for op in ctx.operations]
+    if plan_cache is not None:
+        plan_cache.put(cache_key, {
+            "state": graph_repr,
+            "program": program,
+            "operations": operations,
+            "summary": summary
+        })
+    if with_operations:
+        return graph_repr, program, operations
+    return graph_repr, program
+
+
+def build_plan(old_state, graph_repr, batch=True, profiler=None):
+    """
+    Plans the change like execute, but returns a structured Plan
+    which can be saved and applied later
+    """
+    state_hashes = gf_plan.state_hashes(old_state)
+    ctx, summary = _plan(old_state, graph_repr, batch=batch, profiler=profiler)
+    _print_summary(summary)
+    edges = _operation_edges(ctx.operations, old_state, graph_repr)
+    return gf_plan.Plan(
+        operations=[op.json_repr() for op in ctx.operations],
+        edges=edges,
+        state_hashes=state_hashes,
+        new_state=graph_repr
+    )
+
+
+def plan_operations(old_state, graph_repr, externals=None, batch=True):
+    """
+    Plans the change like execute, without printing the summary,
+    and returns the operations
+    """
+    ctx, _ = _plan(old_state, graph_repr, externals, batch)
+    return ctx.operations
+
+
+def _batch_key(resource):
+    parent = resource["properties"].get("parent")
+    parent_id = parent.get("!ref") if isinstance(parent, dict) else None
+    return resource["resource_type"], parent_id
+
+
+def _execute_wave(ctx, op_type, resources, batch):
+    # within a wave operations are independent, so resources of the same type
+    # which share a parent can be handed to the batch hook of their type
+    groups = {}
+    for resource in resources:
+        key = _batch_key(resource) if batch else resource["id"]
+        groups.setdefault(key, []).append(resource)
+    for group in groups.values():
+        execs = [from_type(repr["resource_type"])(repr) for repr in group]
+        many = getattr(type(execs[0]), op_type + "_many", None)
+        if len(execs) > 1 and many is not None:
+            many(ctx, execs)
+            continue
+        for exec in execs:
+            getattr(exec, op_type)(ctx)
+    return len(resources)
+
+
+def _intern_ids(state):
+    # the same ids are looked up over and over while planning: as keys, ids and
+    # references. interned, the lookups compare by identity
+    items = []
+    for key, resource in state.items():
+        key = sys.intern(key)
+        resource["id"] = sys.intern(resource["id"])
+        for value in resource["properties"].values():
+            if isinstance(value, dict) and "!ref" in value:
+                value["!ref"] = sys.intern(value["!ref"])
+        items.append((key, resource))
+    state.clear()
+    state.update(items)
+
+
+def _plan(old_state, graph_repr, externals=None, batch=True, profiler=None):
+    profiler = profiler or profiling.NO_PROFILER
+    counts = {"resources": len(graph_repr), "old_resources": len(old_state)}
+    _intern_ids(old_state)
+    _intern_ids(graph_repr)
+    with profiler.phase("toposort", **counts):
+        sorted_new_keys = topological_sort(graph_repr)
+        sorted_old_keys = topological_sort(old_state)
+
+    ctx = ScriptCtx(graph_repr, externals, old_state)
+    with profiler.phase("diff", **counts):
+        diff = _diff(ctx, graph_repr, old_state)
+
+    with profiler.phase("emit", **counts):
+        deleted = 0
+        for key_group in sorted_old_keys[::-1]:
+            resources = [old_state[key] for key in sorted(key_group) if key in diff['deleted']]
+            deleted += _execute_wave(ctx, "delete", resources, batch)
+
+        created = 0
+        for key_group in sorted_new_keys:
+            resources = [graph_repr[key] for key in sorted(key_group) if key in diff['created']]
+            created += _execute_wave(ctx, "create", resources, batch)
+
+        modified = 0
+        for key_group in sorted_new_keys:
+            for key in sorted(key_group):
+                if key in diff['modified']:
+                    repr = graph_repr[key]
+                    exec = from_type(repr["resource_type"])(repr)
+                    changed_props = _resource_diff(graph_repr[key], old_state[key])
+                    exec.update(ctx, changed_props)
+                    modified += 1
+
+    # untouched resources keep the status they had, so they are stored unchanged in the new state
+    for key, repr in graph_repr.items():
+        if key in old_state and key not in diff['created'] and key not in diff['modified']:
+            for status_key in ["status", "computed_props"]:
+                if status_key in old_state[key]:
+                    repr[status_key] = old_state[key][status_key]
+
+    summary = {"deleted": deleted, "created": created, "modified": modified}
+    return ctx, summary
+
+
+def _print_summary(summary):
+    print("{deleted} deleted".format(deleted=summary["deleted"]))
+    print("{created} created".format(created=summary["created"]))
+    print("{modified} modified".format(modified=summary["modified"]))
 
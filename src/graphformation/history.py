@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""History
+
+In this module we keep the history of the state for rollback.
+Resources are stored once per distinct content, compressed and addressed
+by the hash of their canonical json, so consecutive versions share all
+unchanged resources. A version is a manifest from resource id to hash,
+stored as the delta to the previous version, with a full manifest every
+few versions so loading a version replays a bounded number of deltas.
+
+    objects/ab/abcdef...   compressed resources
+    versions/000001.z      compressed manifests
+    HEAD                   the latest version
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import zlib
+from graphformation import state_store
+
+
+_SNAPSHOT_EVERY = 32
+
+
+def _dumps(obj):
+    return json.dumps(obj, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def _write_atomic(filename, data):
+    directory = os.path.dirname(filename)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, filename)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class History:
+    """
+    History is a versioned store of states with structural sharing between versions
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self._manifests = {}
+
+    def _object_path(self, digest):
+        return os.path.join(self.directory, "objects", digest[:2], digest)
+
+    def _version_path(self, version):
+        return os.path.join(self.directory, "versions", "{:06d}.z".format(version))
+
+    def latest(self):
+        """
+        :return: the latest version, 0 if nothing has been saved
+        """
+        head = os.path.join(self.directory, "HEAD")
+        if not os.path.isfile(head):
+            return 0
+        with open(head, 'r') as f:
+            return int(f.read().strip())
+
+    def versions(self):
+        """
+        :return: the list of saved versions
+        """
+        return list(range(1, self.latest() + 1))
+
+    def manifest(self, version):
+        """
+        :param version: a saved version
+        :return: a dictionary from resource id to the hash of the resource in that version
+        """
+        if version in self._manifests:
+            return self._manifests[version]
+        if version < 1 or version > self.latest():
+            raise Exception("Cannot find version {version} in {directory}".
+                            format(version=version, directory=self.directory))
+        with open(self._version_path(version), 'rb') as f:
+            record = json.loads(zlib.decompress(f.read()).decode("utf-8"))
+        if record["base"] is None:
+            manifest = record["set"]
+        else:
+            manifest = dict(self.manifest(record["base"]))
+            manifest.update(record["set"])
+            for key in record["removed"]:
+                del manifest[key]
+        self._manifests[version] = manifest
+        return manifest
+
+    def save(self, state):
+        """
+        Saves a state as a new version. Only resources which are not stored yet are written.
+        Concurrent saves have to be serialized, see the on_commit of state_store.commit
+        :param state: the state
+        :return: the new version
+        """
+        manifest = {}
+        for key, resource in state.items():
+            data = _dumps(resource)
+            digest = hashlib.sha256(data).hexdigest()
+            manifest[key] = digest
+            path = self._object_path(digest)
+            if not os.path.isfile(path):
+                _write_atomic(path, zlib.compress(data))
+
+        previous = self.latest()
+        version = previous + 1
+        if previous == 0 or version % _SNAPSHOT_EVERY == 0:
+            record = {"base": None, "set": manifest, "removed": []}
+        else:
+            base = self.manifest(previous)
+            record = {
+                "base": previous,
+                "set": {key: digest for key, digest in manifest.items() if base.get(key) != digest},
+                "removed": sorted(key for key in base if key not in manifest)
+            }
+        _write_atomic(self._version_path(version), zlib.compress(_dumps(record)))
+        _write_atomic(os.path.join(self.directory, "HEAD"), str(version).encode("ascii"))
+        self._manifests[version] = manifest
+        return version
+
+    def _load_resource(self, digest):
+        with open(self._object_path(digest), 'rb') as f:
+            return json.loads(zlib.decompress(f.read()).decode("utf-8"))
+
+    def load(self, version):
+        """
+        :param version: a saved version
+        :return: the state saved as that version
+        """
+        return {key: self._load_resource(digest) for key, digest in self.manifest(version).items()}
+
+    def diff(self, old_version, new_version):
+        """
+        Compares two versions by the hashes of their resources, without loading the resources
+        :param old_version: a saved version
+        :param new_version: a saved version
+        :return: a dictionary with the sorted ids of the added, removed and changed resources
+        """
+        old, new = self.manifest(old_version), self.manifest(new_version)
+        return {
+            "added": sorted(key for key in new if key not in old),
+            "removed": sorted(key for key in old if key not in new),
+            "changed": sorted(key for key in new if key in old and old[key] != new[key])
+        }
+
+    def rollback_graph(self, version):
+        """
+        :param version: the version to roll back to
+        :return: the json representation of the graph of that version, to be planned
+        against the current state with executor.execute(current_state, graph)
+        """
+        return {key: state_store.definition(resource)
+                for key, resource in self.load(version).items()}
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""Index
+
+In this module we define a bidirectional index of the references between resources.
+The index is stored next to the state file in a sqlite database, one row per
+reference, and only the rows of the changed resources are rewritten whenever
+the state is written. Queries read only the rows they need, so queries about
+dependencies, dependents and the impact of a change neither plan the whole
+program nor read the whole index.
+"""
+
+import functools
+import os
+import sqlite3
+import tempfile
+from graphformation import schema as gf_schema
+
+
+def references(resource):
+    """
+    :param resource: the json representation of a resource
+    :return: the ids of the resources referenced by its properties
+    """
+    sources = []
+    for value in resource['properties'].values():
+        if isinstance(value, dict) and '!ref' in value:
+            sources.append(value['!ref'])
+    return sources
+
+
+def reference_properties(resource):
+    """
+    :param resource: the json representation of a resource
+    :return: a dictionary from the properties which hold references to the referenced ids
+    """
+    return {prop: value['!ref'] for prop, value in resource['properties'].items()
+            if isinstance(value, dict) and '!ref' in value}
+
+
+@functools.lru_cache(maxsize=None)
+def _requires_recreate(resource_type, prop):
+    # the executor imports this module
+    from graphformation import executor # pylint: disable=import-outside-toplevel
+    # the providers decide from the changed properties
+    old = {"id": "", "resource_type": resource_type, "properties": {prop: "old"}}
+    new = {"id": "", "resource_type": resource_type, "properties": {prop: "new"}}
+    return executor.from_type(resource_type)(new).requires_recreate(None, old)
+
+
+def index_filename(state_filename):
+    """
+    :param state_filename: the filename where the state is stored
+    :return: the filename where the index of the state is stored
+    """
+    return state_filename + ".index"
+
+
+def _closure(start, edges):
+    seen = set()
+    stack = list(edges(start))
+    while stack:
+        key = stack.pop()
+        if key in seen:
+            continue
+        seen.add(key)
+        stack.extend(edges(key))
+    return seen
+
+
+class _Queries:
+    """
+    _Queries answers the queries of an index from its adjacency, see GraphIndex and StoredIndex
+    """
+    def _type(self, key):
+        raise NotImplementedError
+
+    def _forward(self, key):
+        raise NotImplementedError
+
+    def _reverse(self, key):
+        raise NotImplementedError
+
+    def _properties(self, key):
+        raise NotImplementedError
+
+    def dependencies(self, key, transitive=False):
+        """
+        :param key: the id of a resource
+        :param transitive: if True, returns the transitive closure
+        :return: the ids of the resources the resource references
+        """
+        if transitive:
+            return _closure(key, self._forward)
+        return set(self._forward(key))
+
+    def dependents(self, key, transitive=False):
+        """
+        :param key: the id of a resource
+        :param transitive: if True, returns the transitive closure
+        :return: the ids of the resources which reference the resource
+        """
+        if transitive:
+            return _closure(key, self._reverse)
+        return set(self._reverse(key))
+
+    def blast_radius(self, key, prop=None):
+        """
+        Estimates the impact of changing a property of a resource on the environment.
+        This goes beyond what the executor plans: the executor only re-creates or updates
+        the changed resource itself, it does not cascade to the dependents (see _diff).
+        Here a resource is re-created if its provider requires it for the changed property.
+        A dependent is counted as re-created if its provider requires it for the property
+        which references a re-created resource, e.g. the files of a directory which moves,
+        otherwise as updated
+        :param key: the id of a resource
+        :param prop: the changed property. If None, the resource is assumed to be re-created
+        :return: a dictionary with the ids of the updated and recreated resources,
+        and of the affected resources (the transitive dependents)
+        """
+        resource_type = self._type(key)
+        if resource_type is None:
+            raise Exception("Cannot find resource with id {resource_id}".format(resource_id=key))
+        if prop is not None:
+            if prop not in gf_schema.from_type(resource_type).properties:
+                raise Exception("Resource {resource_id} has no property {prop}".
+                                format(resource_id=key, prop=prop))
+            if not _requires_recreate(resource_type, prop):
+                return {"updated": [key], "recreated": [], "affected": []}
+
+        recreated, updated = {key}, set()
+        stack = [key]
+        while stack:
+            ref = stack.pop()
+            for dependent in self._reverse(ref):
+                if dependent in recreated:
+                    continue
+                props = [p for p, r in self._properties(dependent).items() if r == ref]
+                if any(_requires_recreate(self._type(dependent), p) for p in props):
+                    updated.discard(dependent)
+                    recreated.add(dependent)
+                    stack.append(dependent)
+                else:
+                    updated.add(dependent)
+        return {
+            "updated": sorted(updated),
+            "recreated": sorted(recreated),
+            "affected": sorted(self.dependents(key, transitive=True))
+        }
+
+
+class GraphIndex(_Queries):
+    """
+    GraphIndex keeps the forward (dependencies) and reverse (dependents) adjacency of a graph
+    in memory
+    """
+    def __init__(self):
+        self.forward = {}
+        self.reverse = {}
+        self.types = {}
+        # the properties through which each resource references others
+        self.properties = {}
+
+    @staticmethod
+    def from_state(state):
+        """
+        :param state: a state or the json representation of a graph
+        :return: the index of the state
+        """
+        index = GraphIndex()
+        for resource in state.values():
+            index.add(resource)
+        return index
+
+    def add(self, resource):
+        """
+        Adds or replaces a resource
+        :param resource: the json representation of a resource
+        :return: None
+        """
+        key = resource["id"]
+        if key in self.types:
+            self.remove(key)
+        self.types[key] = resource["resource_type"]
+        self.properties[key] = reference_properties(resource)
+        refs = set(references(resource))
+        self.forward[key] = refs
+        for ref in refs:
+            self.reverse.setdefault(ref, set()).add(key)
+
+    def remove(self, key):
+        """
+        Removes a resource. The references to it are kept,
+        they are removed with the referencing resources
+        :param key: the id of the resource
+        :return: None
+        """
+        for ref in self.forward.pop(key, ()):
+            dependents = self.reverse.get(ref)
+            if dependents is not None:
+                dependents.discard(key)
+                if not dependents:
+                    del self.reverse[ref]
+        self.types.pop(key, None)
+        self.properties.pop(key, None)
+
+    def update(self, new_state):
+        """
+        Brings the index up to date with a new state,
+        touching only resources whose references changed
+        :param new_state: the new state
+        :return: None
+        """
+        for key in [key for key in self.types if key not in new_state]:
+            self.remove(key)
+        for key, resource in new_state.items():
+            if (self.types.get(key) != resource["resource_type"] or
+                    self.properties.get(key) != reference_properties(resource)):
+                self.add(resource)
+
+    def _type(self, key):
+        return self.types.get(key)
+
+    def _forward(self, key):
+        return self.forward.get(key, ())
+
+    def _reverse(self, key):
+        return self.reverse.get(key, ())
+
+    def _properties(self, key):
+        return self.properties.get(key, {})
+
+    def json_repr(self):
+        """
+        Converts the index to dictionary useful for dumping the index into json
+        :return: dictionary
+        """
+        return {
+            "types": self.types,
+            "properties": self.properties,
+            "forward": {key: sorted(refs) for key, refs in self.forward.items()},
+            "reverse": {key: sorted(refs) for key, refs in self.reverse.items()}
+        }
+
+
+_SCHEMA = [
+    "CREATE TABLE generation (generation INTEGER NOT NULL)",
+    "CREATE TABLE resources (id TEXT PRIMARY KEY, resource_type TEXT NOT NULL)",
+    "CREATE TABLE refs (source TEXT NOT NULL, property TEXT NOT NULL, target TEXT NOT NULL)",
+    "CREATE INDEX refs_source ON refs (source)",
+    "CREATE INDEX refs_target ON refs (target)",
+]
+
+
+class StoredIndex(_Queries):
+    """
+    StoredIndex answers queries from the index database of a state file,
+    reading only the rows each query needs
+    """
+    def __init__(self, connection):
+        self._connection = connection
+
+    def _column(self, query, key):
+        return [row[0] for row in self._connection.execute(query, (key,))]
+
+    def _type(self, key):
+        types = self._column("SELECT resource_type FROM resources WHERE id = ?", key)
+        return types[0] if types else None
+
+    def _forward(self, key):
+        return self._column("SELECT target FROM refs WHERE source = ?", key)
+
+    def _reverse(self, key):
+        return self._column("SELECT source FROM refs WHERE target = ?", key)
+
+    def _properties(self, key):
+        return dict(self._connection.execute(
+            "SELECT property, target FROM refs WHERE source = ?", (key,)))
+
+    def close(self):
+        """
+        Closes the database
+        :return: None
+        """
+        self._connection.close()
+
+
+def _generation(connection):
+    try:
+        return connection.execute("SELECT generation FROM generation").fetchone()[0]
+    except sqlite3.DatabaseError:
+        # not an index database, e.g. an index written in the former json format
+        return None
+
+
+def _write_resources(connection, state, keys):
+    connection.executemany("DELETE FROM resources WHERE id = ?", [(key,) for key in keys])
+    connection.executemany("DELETE FROM refs WHERE source = ?", [(key,) for key in keys])
+    connection.executemany("INSERT INTO resources VALUES (?, ?)",
+                           [(key, state[key]["resource_type"]) for key in keys if key in state])
+    connection.executemany("INSERT INTO refs VALUES (?, ?, ?)",
+                           [(key, prop, target) for key in keys if key in state
+                            for prop, target in reference_properties(state[key]).items()])
+
+
+def save(state, generation, state_filename):
+    """
+    Builds the index of a whole state and replaces the stored index with it
+    :param state: the state
+    :param generation: the generation of the state
+    :param state_filename: the filename where the state is stored
+    :return: None
+    """
+    filename = index_filename(state_filename)
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    os.close(fd)
+    try:
+        connection = sqlite3.connect(tmp_path)
+        try:
+            with connection:
+                for statement in _SCHEMA:
+                    connection.execute(statement)
+                connection.execute("INSERT INTO generation VALUES (?)", (generation,))
+                _write_resources(connection, state, list(state))
+        finally:
+            connection.close()
+        os.replace(tmp_path, filename)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load(state_filename, generation):
+    """
+    Opens the index of a state file, see state_store.load_index
+    :param state_filename: the filename where the state is stored
+    :param generation: the generation of the state
+    :return: a StoredIndex, or None if the index is missing or older than the state,
+    e.g. after a crash
+    """
+    filename = index_filename(state_filename)
+    if not os.path.isfile(filename):
+        return None
+    connection = sqlite3.connect(filename)
+    stored_generation = _generation(connection)
+    if stored_generation is not None and stored_generation >= generation:
+        return StoredIndex(connection)
+    connection.close()
+    return None
+
+
+def update(state_filename, previous_state, new_state, generation):
+    """
+    Updates the index of a state file after the new state has been written, rewriting only
+    the rows of the changed resources. A missing index, or one which is not the index of
+    the previous state, is built again when it is loaded, not while the state is locked
+    :param state_filename: the filename where the state is stored
+    :param previous_state: the state which has been replaced
+    :param new_state: the state which has been written
+    :param generation: the generation of the new state
+    :return: None
+    """
+    filename = index_filename(state_filename)
+    if not os.path.isfile(filename):
+        return
+    changed = [key for key in set(previous_state).union(new_state)
+               if previous_state.get(key) != new_state.get(key)]
+    connection = sqlite3.connect(filename)
+    try:
+        if _generation(connection) == generation - 1:
+            with connection:
+                _write_resources(connection, new_state, changed)
+                connection.execute("UPDATE generation SET generation = ?", (generation,))
+            return
+    finally:
+        connection.close()
+    os.remove(filename)
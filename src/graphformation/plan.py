@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""Plan
+
+In this module we define the saved plan artifact.
+A plan holds the operations to execute, the dependency edges between them,
+the hashes of the state the plan was computed against and the new state.
+
+The binary layout is a fixed header followed by a table of sections:
+
+    header:   magic (8 bytes), version (uint32), number of sections (uint32)
+    sections: offset (uint64), length (uint64) for each section
+
+The operations, state hashes and new state sections are compact json.
+The edges section is a flat array of little endian uint32 pairs, which is
+read in place from a memory map without copying.
+"""
+
+import array
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+
+_MAGIC = b"GFPLAN\x00\x00"
+_VERSION = 1
+_HEADER = struct.Struct("<8sII")
+_SECTION = struct.Struct("<QQ")
+_ALIGNMENT = 8
+
+_OPERATIONS = 0
+_EDGES = 1
+_STATE_HASHES = 2
+_NEW_STATE = 3
+_NUM_SECTIONS = 4
+
+
+def _dumps(obj):
+    return json.dumps(obj, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def resource_hash(resource):
+    """
+    :param resource: the json representation of a resource
+    :return: a hex digest of the canonical json of the resource
+    """
+    return hashlib.sha256(_dumps(resource)).hexdigest()
+
+
+def program(operations):
+    """
+    :param operations: the json representations of operations
+    :return: the operations as a human readable shell script
+    """
+    reprs = []
+    for op in operations:
+        commands_repr = "\n".join(map(lambda x: x + " ", op["commands"]))
+        reprs.append(op["comment"] + "\n" + commands_repr + "\n# end\n\n")
+    return "\n".join(reprs)
+
+
+def state_hashes(state):
+    """
+    :param state: a state dictionary as stored in the state file
+    :return: a dictionary from resource id to the hash of the resource
+    """
+    return {key: resource_hash(resource) for key, resource in state.items()}
+
+
+def _edges_array(edges):
+    flat = array.array("I")
+    for i, j in edges:
+        flat.append(i)
+        flat.append(j)
+    return flat
+
+
+class Plan:
+    """
+    Plan is a structured change set which can be saved and applied later
+    """
+    def __init__(self, operations, edges, state_hashes, new_state, # pylint: disable=W0621
+                 sections=None, mapped=None):
+        self._operations = operations
+        self._edges = None if edges is None else _edges_array(edges)
+        self._state_hashes = state_hashes
+        self._new_state = new_state
+        # for a loaded plan these are the memory mapped sections
+        self._sections = sections
+        self._mmap = mapped
+
+    @property
+    def operations(self):
+        """
+        :return: a list of operations, each a dictionary with
+        op_type, resource_type, resource_id, comment and commands
+        """
+        if self._operations is None:
+            self._operations = json.loads(bytes(self._sections[_OPERATIONS]).decode("utf-8"))
+        return self._operations
+
+    @property
+    def edges(self):
+        """
+        :return: a flat sequence of operation indices (before, after, before, after, ...)
+        """
+        if self._edges is None:
+            view = self._sections[_EDGES]
+            if sys.byteorder == "little":
+                self._edges = view.cast("I")
+            else:
+                self._edges = array.array("I", bytes(view))
+                self._edges.byteswap()
+        return self._edges
+
+    @property
+    def state_hashes(self):
+        """
+        :return: the hashes of the resources in the state the plan was computed against
+        """
+        if self._state_hashes is None:
+            self._state_hashes = json.loads(bytes(self._sections[_STATE_HASHES]).decode("utf-8"))
+        return self._state_hashes
+
+    @property
+    def new_state(self):
+        """
+        :return: the state after the plan has been applied
+        """
+        if self._new_state is None:
+            self._new_state = json.loads(bytes(self._sections[_NEW_STATE]).decode("utf-8"))
+        return self._new_state
+
+    def fingerprint(self):
+        """
+        :return: a hex digest identifying the plan
+        """
+        digest = hashlib.sha256()
+        digest.update(_dumps(self.operations))
+        digest.update(_dumps(self.state_hashes))
+        digest.update(_dumps(self.new_state))
+        return digest.hexdigest()
+
+    def dependencies(self):
+        """
+        :return: a dictionary from operation index to the indices it waits for
+        """
+        deps = {j: [] for j in range(len(self.operations))}
+        edges = self.edges
+        for k in range(0, len(edges), 2):
+            deps[edges[k + 1]].append(edges[k])
+        return deps
+
+    def program(self):
+        """
+        :return: the plan as a human readable shell script
+        """
+        return program(self.operations)
+
+    def write(self, filename):
+        """
+        Writes the plan in the binary format
+        :param filename: the file to write to
+        :return: None
+        """
+        edges = array.array("I", self.edges)
+        if sys.byteorder != "little":
+            edges.byteswap()
+        payloads = [
+            _dumps(self.operations),
+            edges.tobytes(),
+            _dumps(self.state_hashes),
+            _dumps(self.new_state)
+        ]
+
+        offset = _HEADER.size + _SECTION.size * _NUM_SECTIONS
+        table = []
+        body = []
+        for payload in payloads:
+            padding = -offset % _ALIGNMENT
+            body.append(b"\0" * padding)
+            offset += padding
+            table.append(_SECTION.pack(offset, len(payload)))
+            body.append(payload)
+            offset += len(payload)
+
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_HEADER.pack(_MAGIC, _VERSION, _NUM_SECTIONS))
+                f.write(b"".join(table))
+                f.write(b"".join(body))
+            os.replace(tmp_path, filename)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def close(self):
+        """
+        Releases the memory map of a loaded plan. Sections which have
+        not been accessed are decoded before the map is released
+        :return: None
+        """
+        if self._mmap is None:
+            return
+        _ = self.operations, self.state_hashes, self.new_state
+        edges = self.edges
+        self._edges = array.array("I", edges)
+        if isinstance(edges, memoryview):
+            edges.release()
+        for section in self._sections:
+            section.release()
+        self._sections = None
+        self._mmap.close()
+        self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load(filename):
+    """
+    Loads a plan by mapping the file into memory. The sections are decoded on first access
+    :param filename: the file written by Plan.write
+    :return: a Plan
+    """
+    with open(filename, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    try:
+        magic, version, num_sections = _HEADER.unpack_from(view, 0)
+        if magic != _MAGIC or version != _VERSION or num_sections != _NUM_SECTIONS:
+            raise Exception("{filename} is not a graphformation plan".format(filename=filename))
+        sections = []
+        for k in range(num_sections):
+            offset, length = _SECTION.unpack_from(view, _HEADER.size + k * _SECTION.size)
+            sections.append(view[offset:offset + length])
+    except BaseException:
+        view.release()
+        mapped.close()
+        raise
+    view.release()
+
+    return Plan(None, None, None, None, sections=sections, mapped=mapped)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Plan cache
+
+In this module we cache the result of planning on disk.
+A plan is keyed on a fingerprint of the program (its canonical json graph)
+and of the state it is planned against. Entries are evicted in LRU order
+once the cache grows beyond its size cap.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+
+_ENTRY_SUFFIX = ".plan.json"
+# is part of every key. Bump it whenever the executor plans the same inputs differently
+# (other operations, commands or order), so plans cached by older code are not returned
+FORMAT_VERSION = 5
+
+
+def _canonical(obj):
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"))
+
+
+def fingerprint(old_state, graph_repr, externals=None, batch=True):
+    """
+    :param old_state: the state the program is planned against
+    :param graph_repr: the json representation of the program
+    :param externals: the referenced resources outside of the program, if any
+    :param batch: whether the plan uses the batch operations of the resource types
+    :return: a hex digest identifying the (program, state) pair
+    """
+    digest = hashlib.sha256()
+    digest.update("graphformation-plan-v{}\0".format(FORMAT_VERSION).encode("ascii"))
+    digest.update(_canonical(graph_repr).encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(_canonical(old_state).encode("utf-8"))
+    if externals:
+        digest.update(b"\0")
+        digest.update(_canonical(externals).encode("utf-8"))
+    if not batch:
+        digest.update(b"\0nobatch")
+    return digest.hexdigest()
+
+
+class PlanCache:
+    """
+    PlanCache stores plans in a directory, one file per fingerprint
+    """
+    def __init__(self, directory, max_entries=256, max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + _ENTRY_SUFFIX)
+
+    def get(self, key):
+        """
+        :param key: the fingerprint of the plan
+        :return: the cached entry or None if there is no such entry
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        # the modification time is the recency marker used by the eviction
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass # evicted by another process since it was read, the entry is still valid
+        return entry
+
+    def put(self, key, entry):
+        """
+        Stores an entry and evicts the least recently used entries if needed
+        :param key: the fingerprint of the plan
+        :param entry: a json serializable dictionary
+        :return: None
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(json.dumps(entry))
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(_ENTRY_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total_bytes = sum(size for _, size, _ in entries)
+        while entries and (len(entries) > self.max_entries or total_bytes > self.max_bytes):
+            _, size, path = entries.pop(0)
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total_bytes -= size
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Profiling
+
+In this module we profile the phases of planning: running the program,
+building its json representation, diffing, sorting and emitting operations.
+Every phase is run under cProfile and tracemalloc, and the report lists
+the hotspots and the peak allocations of each phase with its resource counts.
+"""
+
+import contextlib
+import cProfile
+import io
+import pstats
+import time
+import tracemalloc
+
+
+class _Phase: # pylint: disable=too-few-public-methods
+    def __init__(self, name, counts):
+        self.name = name
+        self.counts = counts
+        self.seconds = 0.0
+        self.peak_bytes = 0
+        self.stats = None
+        self.allocations = []
+
+
+class Profiler:
+    """
+    Profiler collects a cProfile and tracemalloc measurement per phase
+    """
+    def __init__(self, top=20):
+        self.top = top
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name, **counts):
+        """
+        Profiles the body of the with block. Phases must not be nested
+        :param name: the name of the phase
+        :param counts: resource counts the phase is tagged with
+        :return: a context manager
+        """
+        phase = _Phase(name, counts)
+        was_tracing = tracemalloc.is_tracing()
+        if was_tracing:
+            tracemalloc.stop()
+        tracemalloc.start()
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield phase
+        finally:
+            profile.disable()
+            phase.seconds = time.perf_counter() - start
+            _, phase.peak_bytes = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            if was_tracing:
+                tracemalloc.start()
+            phase.allocations = snapshot.statistics("lineno")[:self.top]
+            phase.stats = pstats.Stats(profile)
+            self.phases.append(phase)
+
+    def report(self):
+        """
+        :return: the report as text, one section per phase
+        """
+        out = io.StringIO()
+        for phase in self.phases:
+            counts = ", ".join("{}={}".format(key, value)
+                               for key, value in sorted(phase.counts.items()))
+            out.write("=== {name} ({counts})\n".format(name=phase.name, counts=counts or "-"))
+            out.write("time: {seconds:.3f}s, peak memory: {peak:.1f} KiB\n\n".format(
+                seconds=phase.seconds, peak=phase.peak_bytes / 1024.0))
+            out.write("hotspots by cumulative time:\n")
+            phase.stats.stream = out
+            phase.stats.sort_stats("cumulative").print_stats(self.top)
+            out.write("allocations by line:\n")
+            for stat in phase.allocations:
+                out.write("  {}\n".format(stat))
+            out.write("\n")
+        return out.getvalue()
+
+    def write(self, filename):
+        """
+        Writes the report
+        :param filename: the file to write to
+        :return: None
+        """
+        with open(filename, 'w') as f:
+            f.write(self.report())
+
+
+class _NoProfiler: # pylint: disable=too-few-public-methods
+    @contextlib.contextmanager
+    def phase(self, name, **counts): # pylint: disable=W0613
+        """
+        Measures nothing
+        :param name: the name of the phase
+        :param counts: resource counts the phase is tagged with
+        :return: a context manager which yields None
+        """
+        yield None
+
+
+NO_PROFILER = _NoProfiler()
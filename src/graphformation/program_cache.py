@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""Program cache
+
+In this module we cache the json graph of the last evaluation of a program.
+The cache is keyed on the path of the program, and validated against its
+modification time and size and, when those changed, against a hash of its source.
+Only the source of the program file itself is tracked, not the modules it imports.
+"""
+
+import hashlib
+import json
+import os
+import runpy
+import tempfile
+from graphformation import spec
+
+
+DEFAULT_DIRECTORY = os.path.join(".graphformation", "programs")
+
+
+def _entry_path(directory, program):
+    key = hashlib.sha256(os.path.abspath(program).encode("utf-8")).hexdigest()
+    return os.path.join(directory, key + ".json")
+
+
+def _read_entry(path):
+    try:
+        with open(path, 'r') as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def _write_entry(path, entry):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps(entry))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def evaluate(program):
+    """
+    Runs a program without affecting the global graph
+    :param program: the path of the program
+    :return: the json representation of the graph the program defines
+    """
+    save_graph = spec.GRAPH
+    spec.GRAPH = {}
+    try:
+        # a run name other than __main__ keeps the program from calling runner.run()
+        runpy.run_path(program, run_name="__graphformation__")
+        return spec.graph_repr()
+    finally:
+        spec.GRAPH = save_graph
+
+
+def graph_repr(program, directory=DEFAULT_DIRECTORY):
+    """
+    :param program: the path of the program
+    :param directory: the directory of the cache
+    :return: the json representation of the graph, evaluating the program only if it changed
+    """
+    stat = os.stat(program)
+    path = _entry_path(directory, program)
+    entry = _read_entry(path)
+    if (entry is not None and entry["mtime_ns"] == stat.st_mtime_ns
+            and entry["size"] == stat.st_size):
+        return entry["graph"]
+
+    with open(program, 'rb') as f:
+        source_hash = hashlib.sha256(f.read()).hexdigest()
+    if entry is not None and entry["source_hash"] == source_hash:
+        graph = entry["graph"]
+    else:
+        graph = evaluate(program)
+    _write_entry(path, {
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "source_hash": source_hash,
+        "graph": graph
+    })
+    return graph
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Rate limit
+
+In this module we limit how fast operations are applied against a backend.
+Limits are token buckets (operations per second) and concurrency caps,
+globally and per resource type. Both adapt to the backend: they are halved
+when operations fail or are slow and grow back step by step while they succeed.
+"""
+
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    TokenBucket lets through at most rate operations per second, with bursts up to burst
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1.0, rate))
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self):
+        """
+        Blocks until a token is available and takes it
+        :return: None
+        """
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait = (1.0 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def set_rate(self, rate):
+        """
+        :param rate: the new rate in operations per second
+        :return: None
+        """
+        with self._lock:
+            self._refill()
+            self.rate = float(rate)
+
+
+class Limit:
+    """
+    Limit is an adaptive rate limit and concurrency cap.
+    rate and concurrency are the maximums; the current values move between
+    min_rate (one operation at a time) and them
+    """
+    def __init__(self, rate=None, concurrency=None, min_rate=0.1):
+        if rate is not None and rate <= 0:
+            raise Exception("The rate of a limit must be positive, got {rate}".format(rate=rate))
+        if concurrency is not None and concurrency <= 0:
+            raise Exception("The concurrency of a limit must be positive, got {concurrency}".
+                            format(concurrency=concurrency))
+        self.max_rate = rate
+        self.max_concurrency = concurrency
+        self.min_rate = min_rate
+        self.bucket = TokenBucket(rate) if rate is not None else None
+        self.concurrency = concurrency
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Blocks until the operation may start
+        :return: None
+        """
+        if self.max_concurrency is not None:
+            with self._condition:
+                while self._in_flight >= self.concurrency:
+                    self._condition.wait()
+                self._in_flight += 1
+        if self.bucket is not None:
+            self.bucket.acquire()
+
+    def release(self, ok):
+        """
+        Marks an operation as finished and adapts the limit
+        :param ok: False if the operation failed or was too slow
+        :return: None
+        """
+        with self._condition:
+            if self.max_concurrency is not None:
+                self._in_flight -= 1
+                if ok:
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                else:
+                    self.concurrency = max(1, self.concurrency // 2)
+                self._condition.notify_all()
+            if self.bucket is not None:
+                if ok:
+                    rate = min(self.max_rate, self.bucket.rate + self.max_rate / 10.0)
+                else:
+                    rate = max(self.min_rate, self.bucket.rate / 2.0)
+                self.bucket.set_rate(rate)
+
+
+class Limiter:
+    """
+    Limiter combines a global limit and limits per resource type
+    """
+    def __init__(self, global_limit=None, type_limits=None, slow_seconds=None):
+        self.global_limit = global_limit
+        self.type_limits = type_limits or {}
+        # an operation slower than this counts as a failure for the adaptation
+        self.slow_seconds = slow_seconds
+
+    def _limits(self, resource_type):
+        limits = []
+        if resource_type in self.type_limits:
+            limits.append(self.type_limits[resource_type])
+        if self.global_limit is not None:
+            limits.append(self.global_limit)
+        return limits
+
+    def acquire(self, resource_type):
+        """
+        Blocks until an operation on a resource of the type may start
+        :param resource_type: the resource type of the operation
+        :return: None
+        """
+        for limit in self._limits(resource_type):
+            limit.acquire()
+
+    def release(self, resource_type, ok, seconds):
+        """
+        :param resource_type: the resource type of the operation
+        :param ok: whether the operation succeeded
+        :param seconds: how long the operation took
+        :return: None
+        """
+        if self.slow_seconds is not None and seconds > self.slow_seconds:
+            ok = False
+        for limit in self._limits(resource_type):
+            limit.release(ok)
+
+
+UNLIMITED = Limiter()
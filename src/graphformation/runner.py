@@ -1,25 +1,167 @@
 import argparse
+import json
+import runpy
 from graphformation import spec
 
+# the modules which plan and apply are imported by the modes which need them,
+# so that read-only modes such as -show-json start quickly
+
 parser = argparse.ArgumentParser()
 
 parser.add_argument("-deploy", help="Name of the file which to deploy", action="store_true")
 parser.add_argument("-state-file", help="Name of the state file", default="state.json")
-parser.add_argument("-dry-run", help="Do not run. Only output the change set", default=False)
+parser.add_argument("-dry-run", help="Do not run. Only output the change set", action="store_true")
 
 
 parser.add_argument("-show-json", help="Shows the json representation of the program", action="store_true")
+parser.add_argument("-plan-out", help="Plans the program against the state file and saves the plan to this file")
+parser.add_argument("-apply-plan", help="Applies a plan saved with -plan-out. The program is not needed")
+parser.add_argument("-dependencies", help="Shows the resources which the resource with this id references")
+parser.add_argument("-dependents", help="Shows the resources which reference the resource with this id")
+parser.add_argument("-blast-radius", help=("Estimates what in the environment is updated, recreated and "
+                                           "affected by changing the resource with this id. The plan "
+                                           "itself only changes the resource"))
+parser.add_argument("-property", help="The changed property for -blast-radius. By default the resource is recreated")
+parser.add_argument("-transitive", help="Makes -dependencies and -dependents transitive", action="store_true")
+parser.add_argument("-profile", help=("Profiles running the program and each phase of planning "
+                                      "with cProfile and tracemalloc and writes the report to this file. "
+                                      "Only with -plan-out"))
+parser.add_argument("-workers", help="How many operations -apply-plan applies in parallel", type=int, default=1)
+parser.add_argument("-retries", help="How many times -apply-plan retries a failed operation", type=int, default=0)
+parser.add_argument("-rate", help="At most this many operations per second are applied", type=float)
+parser.add_argument("-concurrency", help="At most this many operations are applied at the same time", type=int)
+parser.add_argument("-type-limit", help=("Limits the operations on a resource type, as TYPE:RATE:CONCURRENCY, "
+                                         "e.g. file:5:2 or directory::4. Can be repeated"), action="append")
+parser.add_argument("-slow-seconds", help="Operations slower than this slow down the rate like failures", type=float)
+parser.add_argument("-program", help=("Path of the program. Use it when invoking the runner with "
+                                      "python -m graphformation.runner. The graph of the program "
+                                      "is cached for -show-json"))
+parser.add_argument("-program-cache", help="Directory of the cache of evaluated programs",
+                    default=".graphformation/programs")
+parser.add_argument("-watch", help=("Plans the program against the state file again every time one of them "
+                                    "changes and prints the changed operations. Requires -program"),
+                    action="store_true")
+
+
+def _profiler(args):
+    if not args.profile:
+        return None
+    from graphformation import profiling
+    return profiling.Profiler()
+
+
+def _load_program(args, profiler):
+    if args.program:
+        from graphformation import profiling
+        with (profiler or profiling.NO_PROFILER).phase("program") as phase:
+            # a run name other than __main__ keeps the program from calling run() again
+            runpy.run_path(args.program, run_name="__graphformation__")
+            if phase is not None:
+                phase.counts["resources"] = len(spec.GRAPH)
+
+
+def _show_json(args):
+    if args.program:
+        from graphformation import program_cache
+        graph = program_cache.graph_repr(args.program, directory=args.program_cache)
+        print(json.dumps(graph, indent=2, sort_keys=True))
+    else:
+        spec.print_graph()
+
+
+def _query_index(args):
+    from graphformation import state_store
+    index = state_store.load_index(args.state_file)
+    if args.dependencies:
+        result = sorted(index.dependencies(args.dependencies, transitive=args.transitive))
+    elif args.dependents:
+        result = sorted(index.dependents(args.dependents, transitive=args.transitive))
+    else:
+        result = index.blast_radius(args.blast_radius, args.property)
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+
+def _plan_out(args):
+    profiler = _profiler(args)
+    _load_program(args, profiler)
+    plan = spec.plan(args.state_file, profiler=profiler)
+    plan.write(args.plan_out)
+    print(plan.program())
+    if profiler is not None:
+        profiler.write(args.profile)
+
+
+def _limiter(args):
+    from graphformation import ratelimit
+
+    def optional(value, convert):
+        return convert(value) if value else None
+
+    try:
+        global_limit = None
+        if args.rate is not None or args.concurrency is not None:
+            global_limit = ratelimit.Limit(rate=args.rate, concurrency=args.concurrency)
+        type_limits = {}
+        for type_limit in args.type_limit or []:
+            resource_type, rate, concurrency = type_limit.split(":")
+            type_limits[resource_type] = ratelimit.Limit(rate=optional(rate, float),
+                                                         concurrency=optional(concurrency, int))
+    except Exception as e: # pylint: disable=broad-except
+        parser.error(str(e))
+    return ratelimit.Limiter(global_limit, type_limits, slow_seconds=args.slow_seconds)
+
+
+def _apply_plan(args):
+    from graphformation import apply as gf_apply
+    from graphformation import plan as gf_plan
+    with gf_plan.load(args.apply_plan) as plan:
+        if args.dry_run:
+            gf_apply.verify_state(plan, args.state_file)
+            print(plan.program())
+        else:
+            gf_apply.apply_plan(plan, args.state_file, workers=args.workers,
+                                limiter=_limiter(args), retries=args.retries)
+
+
+def _watch(args):
+    if not args.program:
+        parser.error("-watch requires -program")
+    from graphformation import watch
+    try:
+        watch.run(args.program, args.state_file)
+    except KeyboardInterrupt:
+        pass
+
+
+def _check_profile(args):
+    # only -plan-out runs the phases which are profiled, other modes would write no report
+    other_modes = [args.deploy, args.show_json, args.dependencies, args.dependents,
+                   args.blast_radius, args.watch]
+    if args.profile and (not args.plan_out or any(other_modes)):
+        parser.error("-profile can only be used with -plan-out")
 
 
 def run():
     args = parser.parse_args()
+    _check_profile(args)
     if args.deploy:
         # TODO:
         print(args.deploy)
         print(args.statefile)
         print(args.dryrun)
     elif args.show_json:
-        spec.print_graph()
+        _show_json(args)
+    elif args.dependencies or args.dependents or args.blast_radius:
+        _query_index(args)
+    elif args.watch:
+        _watch(args)
+    elif args.plan_out:
+        _plan_out(args)
+    elif args.apply_plan:
+        _apply_plan(args)
     else:
         print("No arguments have been specified. Run with -h and read the help.")
 
+
+if __name__ == "__main__":
+    run()
@@ -97,7 +97,8 @@ class File(Schema):
             "filename": Property(required=True, mutable=True),
             "parent": Property(required=True, mutable=False),
             "source": Property(required=custom_validator, mutable=False),
-            "text": Property(required=custom_validator, mutable=False)
+            "text": Property(required=custom_validator, mutable=False),
+            "permissions": Property(required=False, mutable=False)
         }
 
         super().__init__("file", properties)
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""Shards
+
+In this module we partition the state into shards and plan them independently.
+Each shard is stored in its own file in a state directory. A resource may
+reference resources in other shards; those are resolved through the exports,
+the resources which are referenced across shards, stored in the same directory.
+Only the shards touched by a change are planned, in parallel processes.
+The deletes of all shards run before their creates and updates, both in the
+order of the references between the shards.
+"""
+
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from graphformation import executor
+from graphformation import index as gf_index
+from graphformation import plan as gf_plan
+from graphformation import state_store
+
+
+_SHARD_SUFFIX = ".shard.json"
+_EXPORTS_FILENAME = "exports.json"
+
+
+def by_prefix(separator=".", default="default"):
+    """
+    :param separator: the separator between the shard name and the rest of the id
+    :param default: the shard of ids without a separator
+    :return: a function from resource id to the shard name, the part of the id before the separator
+    """
+    def shard_of(resource_id):
+        if separator not in resource_id:
+            return default
+        return resource_id.split(separator, 1)[0]
+    return shard_of
+
+
+def by_module(modules, default="default"):
+    """
+    :param modules: a dictionary from resource id to module name, see spec.modules
+    :param default: the shard of resources defined outside of modules
+    :return: a function from resource id to the shard name, the module of the resource
+    """
+    def shard_of(resource_id):
+        return modules.get(resource_id, default)
+    return shard_of
+
+
+def partition(graph_repr, shard_of):
+    """
+    :param graph_repr: the json representation of a graph
+    :param shard_of: a function from resource id to shard name
+    :return: a dictionary from shard name to the part of the graph in the shard
+    """
+    parts = {}
+    for key, resource in graph_repr.items():
+        parts.setdefault(shard_of(key), {})[key] = resource
+    return parts
+
+
+def _shard_filename(directory, shard):
+    return os.path.join(directory, shard + _SHARD_SUFFIX)
+
+
+def _read_json(filename):
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename, 'r') as f:
+        return json.loads(f.read())
+
+
+def read_shards(directory):
+    """
+    :param directory: the directory where the shards of the state are stored
+    :return: a dictionary from shard name to a tuple of the state of the shard and its generation
+    """
+    shards = {}
+    if not os.path.isdir(directory):
+        return shards
+    for name in os.listdir(directory):
+        if name.endswith(_SHARD_SUFFIX):
+            shard = name[:-len(_SHARD_SUFFIX)]
+            shards[shard] = state_store.read(os.path.join(directory, name))
+    return shards
+
+
+def _changed(old_state, new_graph):
+    if set(old_state) != set(new_graph):
+        return True
+    for key, resource in new_graph.items():
+        if state_store.definition(old_state[key]) != state_store.definition(resource):
+            return True
+    return False
+
+
+def _externals(old_state, new_graph, graph_repr, exports):
+    externals = {}
+    for state in [old_state, new_graph]:
+        for resource in state.values():
+            for ref in gf_index.references(resource):
+                if ref in new_graph:
+                    continue
+                if ref in graph_repr:
+                    externals[ref] = graph_repr[ref]
+                elif ref in exports:
+                    externals[ref] = exports[ref]
+    return externals
+
+
+def _order(graph_repr, shard_of):
+    from toposort import toposort_flatten, CircularDependencyError
+    dependencies = {}
+    for key, resource in graph_repr.items():
+        shard = shard_of(key)
+        dependencies.setdefault(shard, set()).update(
+            shard_of(ref) for ref in gf_index.references(resource)
+            if ref in graph_repr and shard_of(ref) != shard)
+    try:
+        return toposort_flatten(dependencies)
+    except CircularDependencyError as e:
+        raise Exception("The shards reference each other, so their programs cannot run "
+                        "one after the other: {}".format(e.data)) from e
+
+
+def shard_order(graph_repr, shard_of):
+    """
+    :param graph_repr: the json representation of the whole graph
+    :param shard_of: a function from resource id to shard name
+    :return: the names of the shards of the graph, every shard after the shards it references
+    """
+    return _order(graph_repr, shard_of)
+
+
+def _delete_order(old_shards):
+    # a resource which moved to another shard is still referenced from its old shard
+    old_graph = {}
+    old_shard_of = {}
+    for shard, state in old_shards.items():
+        old_graph.update(state)
+        old_shard_of.update((key, shard) for key in state)
+    return _order(old_graph, old_shard_of.get)[::-1]
+
+
+def _plan_shard(job):
+    old_state, new_graph, externals = job
+    return executor.execute(old_state, new_graph, externals=externals, with_operations=True)
+
+
+def _read_directory(state_directory):
+    old_shards = {}
+    generations = {}
+    for shard, (state, generation) in read_shards(state_directory).items():
+        old_shards[shard] = state
+        generations[shard] = generation
+    exports = _read_json(os.path.join(state_directory, _EXPORTS_FILENAME))
+    return old_shards, generations, exports
+
+
+def _touched(old_shards, new_shards, order):
+    order = order + sorted(set(old_shards) - set(order))
+    return [shard for shard in order
+            if _changed(old_shards.get(shard, {}), new_shards.get(shard, {}))]
+
+
+def _jobs(shards, old_shards, new_shards, graph_repr, exports):
+    jobs = []
+    for shard in shards:
+        # the executor marks deleted resources in the old state, so it gets a copy
+        old_state = json.loads(json.dumps(old_shards.get(shard, {})))
+        new_graph = new_shards.get(shard, {})
+        jobs.append((old_state, new_graph, _externals(old_state, new_graph, graph_repr, exports)))
+    return jobs
+
+
+def _plan_shards(jobs, processes):
+    if len(jobs) > 1 and processes != 1:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            return list(pool.map(_plan_shard, jobs))
+    return [_plan_shard(job) for job in jobs]
+
+
+def _commit_shard(filename, base_state, base_generation, state):
+    def remove_if_empty(written_state, _previous_state, _generation):
+        # the lock file keeps the generation, so a shard which is defined again continues from it
+        if not written_state:
+            os.remove(filename)
+    # every shard has its own lock, so runs which touch different shards do not contend
+    written_state, _ = state_store.commit(filename, base_state, base_generation, state,
+                                          on_commit=remove_if_empty)
+    return written_state
+
+
+def _exports(shard_states):
+    resources = {}
+    for state in shard_states:
+        resources.update(state)
+    exports = {}
+    for state in shard_states:
+        for resource in state.values():
+            for ref in gf_index.references(resource):
+                if ref not in state and ref in resources:
+                    exports[ref] = state_store.definition(resources[ref])
+    return exports
+
+
+def _write_exports(state_directory):
+    # the exports are computed from the shards as they are after the commit, under the lock of
+    # the exports, so runs which commit other shards at the same time do not lose their exports
+    def compute():
+        return _exports([state for state, _ in read_shards(state_directory).values()])
+    state_store.rewrite(os.path.join(state_directory, _EXPORTS_FILENAME), compute)
+
+
+def _runs(touched, delete_order, operations):
+    runs = []
+    for shard in delete_order:
+        deletes = [op for op in operations.get(shard, []) if op["op_type"] == "delete"]
+        if deletes:
+            runs.append((shard, gf_plan.program(deletes)))
+    for shard in touched:
+        changes = [op for op in operations[shard] if op["op_type"] != "delete"]
+        if changes:
+            runs.append((shard, gf_plan.program(changes)))
+    return runs
+
+
+def execute(state_directory, graph_repr, shard_of, processes=None):
+    """
+    Executes the resource graph against the sharded state, planning only the touched shards
+    :param state_directory: the directory where the shards of the state are stored
+    :param graph_repr: the json representation of the whole graph
+    :param shard_of: a function from resource id to shard name
+    :param processes: the number of processes used for planning. None uses one per cpu
+    :return: a list of tuples of a shard name and a program, in the order the programs have
+    to run. First the deletes of the planned shards run, every shard before the shards it
+    referenced, so a resource which moves to another shard is deleted before it is created
+    again. Then their creates and updates run, every shard after the shards it references,
+    see shard_order
+    """
+    old_shards, generations, exports = _read_directory(state_directory)
+    new_shards = partition(graph_repr, shard_of)
+    touched = _touched(old_shards, new_shards, shard_order(graph_repr, shard_of))
+    delete_order = [shard for shard in _delete_order(old_shards) if shard in touched]
+    results = _plan_shards(_jobs(touched, old_shards, new_shards, graph_repr, exports), processes)
+
+    os.makedirs(state_directory, exist_ok=True)
+    operations = {}
+    for shard, (state, _, shard_operations) in zip(touched, results):
+        _commit_shard(_shard_filename(state_directory, shard), old_shards.get(shard, {}),
+                      generations.get(shard, 0), state)
+        operations[shard] = shard_operations
+    _write_exports(state_directory)
+    return _runs(touched, delete_order, operations)
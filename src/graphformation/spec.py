@@ -5,12 +5,14 @@ In this module we define(specify) our resources
 """
 
 
+import contextlib
 import json
-import os
 from graphformation import schema as gf_schema
-from graphformation import executor
 
 
+# the executor (and toposort), the index and the state store are imported lazily
+# by the functions which plan, so that programs which only define or print the graph start quickly
+
 # for simplicity our graph is global
 # see execute_change_program how to execute two programs without poluting the state
 GRAPH = {}
@@ -19,6 +21,10 @@ GRAPH = {}
 _RESERVED_WORDS = ["!ref"]
 
 
+# the names of the modules which are being defined, see module()
+_MODULES = []
+
+
 def _verify_id(resource_id):
     if resource_id in _RESERVED_WORDS:
         raise Exception("id cannot be the reserved word {resource_id}".
@@ -29,12 +35,14 @@ class Resource: # pylint: disable=too-few-public-methods
     """
     Resource represents a virtual resource
     """
-    def __init__(self, resource_id, resource_type, properties, schema):
+    def __init__(self, resource_id, resource_type, properties, schema, # pylint: disable=R0913
+                 module_name=None):
         _verify_id(resource_id)
         self.resource_id = resource_id
         self.resource_type = resource_type
         self.properties = properties
         self.schema = schema
+        self.module = module_name
 
     def json_repr(self):
         """
@@ -85,7 +93,8 @@ def _add_to_graph(obj):
 
 def _define(resource_id, resource_type, properties):
     resource_schema = gf_schema.from_type(resource_type)
-    resource = Resource(resource_id, resource_type, properties, resource_schema)
+    module_name = _MODULES[-1] if _MODULES else None
+    resource = Resource(resource_id, resource_type, properties, resource_schema, module_name)
 
     _add_to_graph(resource)
     return resource
@@ -137,6 +146,29 @@ def dummy_ref_resource(*, resource_id, mutable_parent=None, immutable_parent=Non
     })
 
 
+@contextlib.contextmanager
+def module(name):
+    """
+    The resources defined inside the with block belong to the module.
+    Modules are explicit boundaries along which the state can be sharded
+    :param name: the name of the module
+    :return: a context manager
+    """
+    _MODULES.append(name)
+    try:
+        yield
+    finally:
+        _MODULES.pop()
+
+
+def modules():
+    """
+    :return: a dictionary from resource id to the module it was defined in
+    """
+    return {resource_id: resource.module
+            for resource_id, resource in GRAPH.items() if resource.module is not None}
+
+
 def ref(obj):
     """
     :param input: a resource
@@ -164,43 +196,91 @@ def print_graph():
     print(json.dumps(graph_repr(), indent=2, sort_keys=True))
 
 
-def _read_state(filename):
-    if not os.path.isfile(filename):
-        return {}
-    with open(filename, 'r') as f:
-        contents = f.read()
-    return json.loads(contents)
+def _profiled_graph_repr(profiler):
+    from graphformation import profiling
+    profiler = profiler or profiling.NO_PROFILER
+    with profiler.phase("graph_repr", resources=len(GRAPH)):
+        return graph_repr()
 
 
-def execute(filename):
+def execute(filename, plan_cache=None, history=None, profiler=None, with_operations=False):
     """
     Executes or applies the resource graph
     :param filename: the filename where the state will be stored
-    :return: a tuple of the json representation of the state and an executable program
+    :param plan_cache: an optional PlanCache; on a hit the cached plan is returned
+    :param history: an optional History in which the new state is saved as a new version
+    :param profiler: an optional Profiler which measures each phase of planning
+    :param with_operations: if True, the list of operations is returned as well
+    :return: a tuple of the json representation of the state and an executable program,
+    followed by the operations if with_operations
+    """
+    from graphformation import executor
+    from graphformation import state_store
+    base_state, generation = state_store.read(filename)
+    # the executor marks deleted resources in the old state, so it gets a copy
+    old_state = json.loads(json.dumps(base_state))
+    result = executor.execute(old_state, _profiled_graph_repr(profiler), plan_cache=plan_cache,
+                              profiler=profiler, with_operations=with_operations)
+
+    state_store.commit(filename, base_state, generation, result[0],
+                       on_commit=state_store.index_and_history(filename, history))
+    return result
+
+
+def plan(filename, profiler=None):
+    """
+    Plans the resource graph against the state without changing the state
+    :param filename: the filename where the state is stored
+    :param profiler: an optional Profiler which measures each phase of planning
+    :return: a Plan which can be saved and applied later
     """
-    old_state = _read_state(filename)
-    json_repr = graph_repr()
-    _, prog = executor.execute(old_state, json_repr)
+    from graphformation import executor
+    from graphformation import state_store
+    old_state, _ = state_store.read(filename)
+    return executor.build_plan(old_state, _profiled_graph_repr(profiler), profiler=profiler)
+
 
-    with open(filename, 'w') as f:
-        f.write(json.dumps(graph_repr, indent=2))
-    return json_repr, prog
+def execute_sharded(state_directory, shard_of=None, processes=None):
+    """
+    Executes the resource graph against a state which is sharded into a directory.
+    Only the shards touched by the change are planned, in parallel processes
+    :param state_directory: the directory where the shards of the state are stored
+    :param shard_of: a function from resource id to shard name.
+    By default the modules are the shards
+    :param processes: the number of processes used for planning
+    :return: a list of tuples of a shard name and a program, in the order the programs
+    have to run, see shards.execute
+    """
+    from graphformation import shards
+    if shard_of is None:
+        shard_of = shards.by_module(modules())
+    return shards.execute(state_directory, graph_repr(), shard_of, processes=processes)
 
 
-def execute_change_program(f, old_state):
+def execute_change_program(f, old_state, plan_cache=None, profiler=None, with_operations=False):
     """
     Executes a program without affecting global state. It is not thread safe
     :param f: a function which manipulates resources
     :param old_state: the previous state of the resoures
-    :return: a tuple of the json representation of the state and an executable program
+    :param plan_cache: an optional PlanCache; on a hit the cached plan is returned
+    :param profiler: an optional Profiler which measures each phase, including running the program
+    :param with_operations: if True, the list of operations is returned as well
+    :return: a tuple of the json representation of the state and an executable program,
+    followed by the operations if with_operations
     """
+    from graphformation import executor
+    from graphformation import profiling
     global GRAPH # pylint: disable=W0603
     save_graph = GRAPH
     GRAPH = {}
     try:
-        f() # run the program
-        json_repr = graph_repr()
-        result = executor.execute(old_state, json_repr)
+        with (profiler or profiling.NO_PROFILER).phase("program") as phase:
+            f() # run the program
+            if phase is not None:
+                phase.counts["resources"] = len(GRAPH)
+        json_repr = _profiled_graph_repr(profiler)
+        result = executor.execute(old_state, json_repr, plan_cache=plan_cache, profiler=profiler,
+                                  with_operations=with_operations)
     finally:
         GRAPH = save_graph
     return result
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""State store
+
+In this module we read and write state files safely from concurrent runs.
+Every state file has a lock file next to it, which is locked with fcntl
+and which holds the generation number of the state. A run reads the state
+together with its generation and commits its new state with compare and swap:
+if another run has committed in between, the two changes are merged per
+resource, unless both runs changed the same or adjacent resources.
+A run which applies operations to the environment reserves the resources
+it changes before it runs them, so concurrent runs fail before, not after,
+the environment has been changed.
+"""
+
+import copy
+import fcntl
+import json
+import os
+import tempfile
+from graphformation import index as gf_index
+
+
+_STATUS_KEYS = ["status", "computed_props"]
+
+
+class ConflictError(Exception):
+    """
+    ConflictError is raised when a concurrent run has changed the same resources
+    """
+
+
+def definition(resource):
+    """
+    :param resource: a resource as stored in the state
+    :return: the resource without the keys written by the executor (status, computed_props)
+    """
+    return {key: value for key, value in resource.items() if key not in _STATUS_KEYS}
+
+
+class _Lock:
+    def __init__(self, filename, exclusive):
+        self.filename = filename + ".lock"
+        self.exclusive = exclusive
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+    def generation(self):
+        """
+        :return: the generation of the state, 0 if it has never been committed
+        """
+        contents = os.pread(self.fd, 32, 0).strip()
+        return int(contents) if contents else 0
+
+    def set_generation(self, generation):
+        """
+        :param generation: the generation of the state which has just been written
+        :return: None
+        """
+        data = str(generation).encode("ascii")
+        os.ftruncate(self.fd, 0)
+        os.pwrite(self.fd, data, 0)
+        os.fsync(self.fd)
+
+
+def _read_state(filename):
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename, 'r') as f:
+        return json.loads(f.read())
+
+
+def _write_state(filename, state):
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps(state, indent=2))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, filename)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def read(filename):
+    """
+    Reads the state under a shared lock
+    :param filename: the filename where the state is stored
+    :return: a tuple of the state and its generation
+    """
+    with _Lock(filename, exclusive=False) as lock:
+        return _read_state(filename), lock.generation()
+
+
+def _changed_ids(base_state, state):
+    changed = set(base_state).symmetric_difference(state)
+    for key in set(base_state).intersection(state):
+        if definition(base_state[key]) != definition(state[key]):
+            changed.add(key)
+    return changed
+
+
+def _neighbours(ids, states):
+    # the resources which reference, or are referenced by, the resources with these ids
+    result = set()
+    for state in states:
+        for key, resource in state.items():
+            refs = gf_index.references(resource)
+            if key in ids:
+                result.update(refs)
+            elif any(ref in ids for ref in refs):
+                result.add(key)
+    return result
+
+
+def _conflicts(ours, theirs, states):
+    # a change next to a change of the other run can leave a dangling reference
+    return (ours.intersection(theirs) |
+            ours.intersection(_neighbours(theirs, states)) |
+            theirs.intersection(_neighbours(ours, states)))
+
+
+def merge(base_state, current_state, new_state):
+    """
+    Applies the changes from base_state to new_state on top of current_state
+    :param base_state: the state both changes started from
+    :param current_state: the state committed by another run
+    :param new_state: the state of this run
+    :return: the merged state. raises ConflictError if both changed the same resources,
+    or one changed a resource which references or is referenced by a resource the other changed
+    """
+    ours = _changed_ids(base_state, new_state)
+    theirs = _changed_ids(base_state, current_state)
+    conflicts = _conflicts(ours, theirs, [base_state, current_state, new_state])
+    if conflicts:
+        raise ConflictError(("The resources {resource_ids} have been changed by a concurrent run. "
+                             "Run again to plan against the new state.").
+                            format(resource_ids=", ".join(sorted(conflicts))))
+    merged = copy.copy(current_state)
+    for key in ours:
+        if key in new_state:
+            merged[key] = new_state[key]
+        else:
+            merged.pop(key, None)
+    return merged
+
+
+def reservations_filename(filename):
+    """
+    :param filename: the filename where the state is stored
+    :return: the filename where the reservations of unfinished applies are stored
+    """
+    return filename + ".reservations"
+
+
+def _check_reservations(filename, owner, ours, states):
+    reservations = _read_state(reservations_filename(filename))
+    for other, reserved in sorted(reservations.items()):
+        if other == owner:
+            continue
+        conflicts = _conflicts(ours, set(reserved), states)
+        if conflicts:
+            raise ConflictError(("The resources {resource_ids} are reserved by the unfinished "
+                                 "apply of plan {plan}. Resume it, or remove {filename} "
+                                 "if it was abandoned.").
+                                format(resource_ids=", ".join(sorted(conflicts)), plan=other,
+                                       filename=reservations_filename(filename)))
+    return reservations
+
+
+def reserve(filename, base_state, base_generation, new_state, owner):
+    """
+    Reserves the resources a run is going to change, before it changes the environment.
+    Until the run commits, concurrent commits and reservations of the same or adjacent
+    resources raise ConflictError
+    :param filename: the filename where the state is stored
+    :param base_state: the state the change was planned against, as returned by read
+    :param base_generation: the generation of base_state, as returned by read
+    :param new_state: the state after the change
+    :param owner: the id of the run, e.g. the fingerprint of its plan. A run which is
+    resumed reserves again with the same id
+    :return: None. raises ConflictError if the resources have been changed or reserved
+    by a concurrent run
+    """
+    with _Lock(filename, exclusive=True) as lock:
+        current_state = base_state
+        if lock.generation() != base_generation:
+            current_state = _read_state(filename)
+            merge(base_state, current_state, new_state)
+        ours = _changed_ids(base_state, new_state)
+        states = [base_state, current_state, new_state]
+        reservations = _check_reservations(filename, owner, ours, states)
+        reservations[owner] = sorted(ours)
+        _write_state(reservations_filename(filename), reservations)
+
+
+def commit(filename, base_state, base_generation, new_state, owner=None, on_commit=None): # pylint: disable=R0913
+    """
+    Writes the new state under an exclusive lock, if needed merging it with concurrent commits
+    :param filename: the filename where the state is stored
+    :param base_state: the state the change was planned against, as returned by read
+    :param base_generation: the generation of base_state, as returned by read
+    :param new_state: the state after the change
+    :param owner: the id the run reserved its resources with, the reservation is released
+    :param on_commit: an optional function which is called with the written state, the state
+    it replaced and the new generation while the lock is still held, e.g. to save it in the
+    history in the order of the commits
+    :return: a tuple of the state which was written and its generation
+    """
+    with _Lock(filename, exclusive=True) as lock:
+        generation = lock.generation()
+        current_state = base_state
+        ours = _changed_ids(base_state, new_state)
+        if generation != base_generation:
+            current_state = _read_state(filename)
+            new_state = merge(base_state, current_state, new_state)
+        states = [base_state, current_state, new_state]
+        reservations = _check_reservations(filename, owner, ours, states)
+        _write_state(filename, new_state)
+        lock.set_generation(generation + 1)
+        if on_commit is not None:
+            on_commit(new_state, current_state, generation + 1)
+        if owner in reservations:
+            del reservations[owner]
+            if reservations:
+                _write_state(reservations_filename(filename), reservations)
+            else:
+                os.remove(reservations_filename(filename))
+        return new_state, generation + 1
+
+
+def rewrite(filename, compute):
+    """
+    Replaces a file derived from states atomically under an exclusive lock
+    :param filename: the filename of the derived file
+    :param compute: a function which returns the json contents, called while the lock is held
+    :return: the written contents
+    """
+    with _Lock(filename, exclusive=True):
+        contents = compute()
+        _write_state(filename, contents)
+        return contents
+
+
+def index_and_history(filename, history=None):
+    """
+    :param filename: the filename where the state is stored
+    :param history: an optional History
+    :return: an on_commit for commit, which updates the index of the state and saves it
+    in the history. Under the lock of the state, concurrent runs save their versions
+    one after the other, and only the changed resources are written to the index
+    """
+    def on_commit(written_state, previous_state, written_generation):
+        gf_index.update(filename, previous_state, written_state, written_generation)
+        if history is not None:
+            history.save(written_state)
+    return on_commit
+
+
+def load_index(filename):
+    """
+    Opens the index of a state file. An index which is missing or older than the state,
+    e.g. after a crash, is built again from the state
+    :param filename: the filename where the state is stored
+    :return: a gf_index.StoredIndex
+    """
+    with _Lock(filename, exclusive=False) as lock:
+        index = gf_index.load(filename, lock.generation())
+    if index is None:
+        state, state_generation = read(filename)
+        gf_index.save(state, state_generation, filename)
+        index = gf_index.load(filename, state_generation)
+    return index
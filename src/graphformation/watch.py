@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""Watch
+
+In this module we plan a program again every time its files change.
+The graph of the last evaluation, the state and the operations of every
+resource are kept in memory. Only the resources whose json representation
+changed, and the resources which reference them, are planned again, and
+only the operations which changed are printed.
+Changes are detected with inotify on Linux and by polling elsewhere.
+"""
+
+import collections
+import copy
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+import traceback
+from graphformation import executor
+from graphformation import index as gf_index
+from graphformation import program_cache
+from graphformation import state_store
+
+
+POLL_INTERVAL = 0.5
+# editors write a file in several steps, the events within this time count as one change
+_SETTLE_SECONDS = 0.05
+
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_EVENT = struct.Struct("iIII")
+
+
+class _Inotify:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # the directories are watched, editors often replace a file instead of writing it
+        self._directories = {}
+        self._names = {}
+
+    def watch(self, filenames):
+        """
+        :param filenames: the files to watch, replacing the files watched before
+        :return: None
+        """
+        self._names = {}
+        for filename in filenames:
+            directory, name = os.path.split(os.path.abspath(filename))
+            if directory not in self._directories:
+                mask = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+                wd = self._add_watch(self._fd, os.fsencode(directory), mask)
+                if wd < 0:
+                    raise OSError(ctypes.get_errno(), "Cannot watch " + directory)
+                self._directories[directory] = wd
+            self._names.setdefault(self._directories[directory], set()).add(os.fsencode(name))
+
+    def _read_events(self):
+        changed = False
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, _, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                changed = changed or name in self._names.get(wd, ())
+
+    def wait(self, timeout=None):
+        """
+        :param timeout: the seconds to wait, None waits until a file changes
+        :return: whether a watched file changed
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            ready, _, _ = select.select([self._fd], [], [], remaining)
+            if not ready:
+                return False
+            if self._read_events():
+                time.sleep(_SETTLE_SECONDS)
+                self._read_events()
+                return True
+
+    def close(self):
+        """
+        Stops watching
+        :return: None
+        """
+        os.close(self._fd)
+
+
+def _stat(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class _Polling:
+    def __init__(self, interval=POLL_INTERVAL):
+        self.interval = interval
+        self._stats = {}
+
+    def watch(self, filenames):
+        """
+        :param filenames: the files to watch, replacing the files watched before
+        :return: None
+        """
+        self._stats = {filename: _stat(filename) for filename in filenames}
+
+    def wait(self, timeout=None):
+        """
+        :param timeout: the seconds to wait, None waits until a file changes
+        :return: whether a watched file changed
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while deadline is None or time.monotonic() < deadline:
+            time.sleep(self.interval if deadline is None else
+                       max(0.0, min(self.interval, deadline - time.monotonic())))
+            if any(_stat(filename) != stat for filename, stat in self._stats.items()):
+                return True
+        return False
+
+    def close(self):
+        """
+        Stops watching
+        :return: None
+        """
+
+
+
+def watcher(interval=POLL_INTERVAL):
+    """
+    :param interval: the interval of polling when inotify is not available
+    :return: a watcher with watch(filenames), wait(timeout) which returns whether a file changed,
+    and close()
+    """
+    try:
+        return _Inotify()
+    except (OSError, AttributeError, TypeError):
+        return _Polling(interval)
+
+
+class IncrementalPlanner:
+    """
+    IncrementalPlanner plans a sequence of graphs against the same state.
+    The operations of a resource depend on its definition, its state and the
+    resources it references, so after a change only the changed resources
+    and the resources referencing them are planned again.
+    Operations are not batched, so every operation belongs to one resource
+    """
+    def __init__(self, old_state):
+        self.old_state = old_state
+        self.graph = {}
+        self._old_index = gf_index.GraphIndex.from_state(old_state)
+        self._old_waves = executor.topological_sort(old_state)
+        self._index = gf_index.GraphIndex()
+        self._new_waves = None
+        self._operations = {}
+
+    def update(self, graph):
+        """
+        :param graph: the json representation of the new graph
+        :return: a tuple of the ids of the changed resources, the new and the dropped operations
+        """
+        changed = self._changed(graph)
+        self._update_index(graph, changed)
+
+        affected = set(changed)
+        for key in changed:
+            affected.update(self._index.dependents(key))
+            affected.update(self._old_index.dependents(key))
+        added, dropped = self._replan(graph, affected)
+        self.graph = graph
+        return changed, self._ordered(added), sorted(dropped, key=lambda op: op["comment"])
+
+    def _changed(self, graph):
+        if self._new_waves is None:
+            return set(graph) | set(self.old_state)
+        changed = {key for key, resource in graph.items() if self.graph.get(key) != resource}
+        changed.update(key for key in self.graph if key not in graph)
+        return changed
+
+    def _update_index(self, graph, changed):
+        # the order of the plan only changes when references change
+        structure_changed = self._new_waves is None
+        for key in changed:
+            refs = set(gf_index.references(graph[key])) if key in graph else None
+            structure_changed = structure_changed or refs != self._index.forward.get(key)
+            if key in graph:
+                self._index.add(graph[key])
+            else:
+                self._index.remove(key)
+        if structure_changed:
+            self._new_waves = executor.topological_sort(graph)
+
+    def _replan(self, graph, affected):
+        sub_graph = {key: copy.deepcopy(graph[key]) for key in affected if key in graph}
+        sub_state = {key: copy.deepcopy(self.old_state[key])
+                     for key in affected if key in self.old_state}
+        # references to resources which are not planned again resolve to the graph,
+        # then to the state
+        externals = collections.ChainMap(graph, self.old_state)
+        operations = executor.plan_operations(sub_state, sub_graph, externals=externals,
+                                              batch=False)
+
+        planned = {}
+        for operation in operations:
+            planned.setdefault(operation.resource_id, []).append(operation)
+        added, dropped = [], []
+        for key in affected:
+            before = [op.json_repr() for op in self._operations.pop(key, [])]
+            after = planned.get(key, [])
+            if after:
+                self._operations[key] = after
+            dropped.extend(op for op in before if op not in [a.json_repr() for a in after])
+            added.extend(op for op in after if op.json_repr() not in before)
+        return added, dropped
+
+    def _ordered(self, operations):
+        position = {id(op): i for i, op in enumerate(self.operations())}
+        return sorted(operations, key=lambda op: position[id(op)])
+
+    def operations(self):
+        """
+        :return: the operations of the whole plan, in the order executor.execute emits them
+        """
+        result = []
+        for wave in self._old_waves[::-1]:
+            for key in sorted(wave):
+                result.extend(op for op in self._operations.get(key, []) if op.op_type == "delete")
+        for op_type in ["create", "update"]:
+            for wave in self._new_waves:
+                for key in sorted(wave):
+                    result.extend(op for op in self._operations.get(key, [])
+                                  if op.op_type == op_type)
+        return result
+
+    def program(self):
+        """
+        :return: the program of the whole plan
+        """
+        return "\n".join(op.dump(2) for op in self.operations())
+
+    def summary(self):
+        """
+        :return: the number of deleted, created and modified resources
+        """
+        counts = collections.Counter(op.op_type
+                                     for ops in self._operations.values() for op in ops)
+        return {"deleted": counts["delete"], "created": counts["create"],
+                "modified": counts["update"]}
+
+
+class Session:
+    """
+    Session evaluates a program and plans it against a state file whenever either changes
+    """
+    def __init__(self, program, state_filename, out=None):
+        self.program = program
+        self.state_filename = state_filename
+        self.out = out or sys.stdout
+        self.planner = None
+        self._state_stat = None
+        # modules of the program's directory which it imported, they are imported again on a change
+        self._modules = {}
+
+    def files(self):
+        """
+        :return: the files whose change triggers planning again
+        """
+        return [self.program, self.state_filename] + sorted(self._modules.values())
+
+    def _evaluate(self):
+        for name in self._modules:
+            sys.modules.pop(name, None)
+        before = set(sys.modules)
+        try:
+            return program_cache.evaluate(self.program)
+        finally:
+            directory = os.path.dirname(os.path.abspath(self.program))
+            self._modules = {}
+            for name in set(sys.modules) - before:
+                filename = getattr(sys.modules[name], "__file__", None)
+                if filename and os.path.abspath(filename).startswith(directory + os.sep):
+                    self._modules[name] = os.path.abspath(filename)
+
+    def replan(self):
+        """
+        Evaluates the program and prints the operations which changed since the last plan
+        :return: None
+        """
+        start = time.perf_counter()
+        try:
+            graph = self._evaluate()
+        except Exception: # pylint: disable=broad-except
+            # a program being edited is often broken, the last plan stays
+            traceback.print_exc(file=self.out)
+            return
+
+        state_stat = _stat(self.state_filename)
+        if self.planner is None or state_stat != self._state_stat:
+            state, _ = state_store.read(self.state_filename)
+            self.planner = IncrementalPlanner(state)
+            self._state_stat = state_stat
+        changed, added, dropped = self.planner.update(graph)
+
+        out = self.out
+        out.write("# {changed} resources changed, planned in {seconds:.3f}s\n".format(
+            changed=len(changed), seconds=time.perf_counter() - start))
+        for op in dropped:
+            out.write("# dropped: {comment}\n".format(comment=op["comment"]))
+        if dropped:
+            out.write("\n")
+        for op in added:
+            out.write(op.dump(2) + "\n")
+        out.write("# plan: {deleted} deleted, {created} created, {modified} modified\n\n".format(
+            **self.planner.summary()))
+        out.flush()
+
+
+def run(program, state_filename, watch=None, out=None):
+    """
+    Plans the program, then plans it again on every change until interrupted
+    :param program: the path of the program
+    :param state_filename: the filename where the state is stored
+    :param watch: a watcher, by default inotify with a polling fallback
+    :param out: where the plans are printed, by default stdout
+    :return: None
+    """
+    session = Session(program, state_filename, out)
+    watch = watch or watcher()
+    try:
+        session.replan()
+        while True:
+            watch.watch(session.files())
+            if watch.wait():
+                session.replan()
+    finally:
+        watch.close()
@@ -1,3 +1,15 @@
 pylint --rcfile=.pylintrc example/example.py 
 pylint --rcfile=.pylintrc graphformation/spec.py
 pylint --rcfile=.pylintrc graphformation/schema.py
+pylint --rcfile=.pylintrc graphformation/plan_cache.py
+pylint --rcfile=.pylintrc graphformation/plan.py
+pylint --rcfile=.pylintrc graphformation/apply.py
+pylint --rcfile=.pylintrc graphformation/checkpoint.py
+pylint --rcfile=.pylintrc graphformation/program_cache.py
+pylint --rcfile=.pylintrc graphformation/index.py
+pylint --rcfile=.pylintrc graphformation/shards.py
+pylint --rcfile=.pylintrc graphformation/state_store.py
+pylint --rcfile=.pylintrc graphformation/history.py
+pylint --rcfile=.pylintrc graphformation/profiling.py
+pylint --rcfile=.pylintrc graphformation/ratelimit.py
+pylint --rcfile=.pylintrc graphformation/watch.py
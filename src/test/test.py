@@ -123,7 +123,7 @@ def test_add_new_resource():
 
     expected_exec1 = """
 # create directory another_dir
-mkdir -f /tmp/another_directory 
+mkdir -p /tmp/another_directory 
 # end
     """
     assert(exec1.strip() == expected_exec1.strip())
@@ -184,9 +184,9 @@ rm -f /tmp/mydirectory/file1
 
 
 # create file contentfile
-echo << ENDOFFILE
+cat > /tmp/another_directory/file1 << 'ENDOFFILE'
 Lorem ipsum dolor
-ENDOFFILE > /tmp/another_directory/file1
+ENDOFFILE
  
 # end
     """
@@ -281,4 +281,210 @@ echo create: {"id": "resource2", "properties": {}, "resource_type": "dummy_ref_r
 echo create: {"id": "resource1", "properties": {"immutable_parent": {"!ref": "resource2"}}, "resource_type": "dummy_ref_resource"} 
 # end
     """
-    assert (exec1.strip() == expected_exec1.strip())
\ No newline at end of file
+    assert (exec1.strip() == expected_exec1.strip())
+
+def test_batch_delete_files():
+    """
+    we test that deleting files which share a directory is a single operation
+    """
+    def p1():
+        mydir = directory(
+          resource_id="dir",
+          permissions="777",
+          location="/tmp/mydirectory"
+        )
+
+        for k in range(3):
+            file(
+                resource_id="file{}".format(k),
+                filename="file{}".format(k),
+                parent=ref(mydir),
+                source="https://webserver.com/file{}.txt".format(k)
+            )
+
+    def p2():
+        directory(
+          resource_id="dir",
+          permissions="777",
+          location="/tmp/mydirectory"
+        )
+
+    state0, exec0 = execute_change_program(lambda: p1(), {})
+    state1, exec1 = execute_change_program(lambda: p2(), state0)
+
+    expected_exec1 = """
+# delete file file0, file1, file2
+rm -f /tmp/mydirectory/file0 /tmp/mydirectory/file1 /tmp/mydirectory/file2 
+# end
+    """
+    assert (exec1.strip() == expected_exec1.strip())
+
+
+def _unbatched_program(f):
+    from graphformation import executor
+    from graphformation import spec
+    save_graph = spec.GRAPH
+    spec.GRAPH = {}
+    try:
+        f()
+        return executor.execute({}, graph_repr(), batch=False)[1]
+    finally:
+        spec.GRAPH = save_graph
+
+
+def test_batch_create_files():
+    """
+    we test that creating text files which share a directory is a single tar extraction,
+    when it is smaller than a command per file
+    """
+    def p1():
+        mydir = directory(
+          resource_id="dir",
+          permissions="777",
+          location="/tmp/mydirectory"
+        )
+
+        for k in range(files):
+            file(
+                resource_id="file{}".format(k),
+                filename="file{}".format(k),
+                parent=ref(mydir),
+                text="Lorem ipsum dolor"
+            )
+
+    files = 20
+    state0, exec0 = execute_change_program(lambda: p1(), {})
+    operations = exec0.strip().split("\n\n\n")
+    assert (len(operations) == 2)
+    assert (operations[1].startswith("# create file file0, file1, "))
+    commands = operations[1].split("\n")[1:-1]
+    assert (len(commands) == 1)
+    assert (commands[0].startswith("echo "))
+    assert ("| base64 -d | tar -xz -m --no-same-owner --no-same-permissions -C /tmp/mydirectory"
+            in commands[0])
+    assert (len(exec0) < len(_unbatched_program(p1)) / 2)
+
+    # for two small files an archive is larger than a here-document per file
+    files = 2
+    state0, exec0 = execute_change_program(lambda: p1(), {})
+    assert ("cat > /tmp/mydirectory/file1 << 'ENDOFFILE'" in exec0)
+    assert ("base64" not in exec0)
+
+
+def test_batch_create_files_like_unbatched():
+    """
+    we test that a batch writes a file with both text and source once and
+    writes an absolute filename at that path
+    """
+    def p1():
+        mydir = directory(
+          resource_id="dir",
+          permissions="777",
+          location="/tmp/mydirectory"
+        )
+        file(resource_id="both", filename="both", parent=ref(mydir), text="text",
+             source="https://webserver.com/both.txt")
+        for k in range(20):
+            file(resource_id="file{}".format(k), filename="file{}".format(k),
+                 parent=ref(mydir), text="Lorem ipsum dolor")
+        file(resource_id="absolute", filename="/tmp/absolute", parent=ref(mydir), text="text")
+
+    _, batched = execute_change_program(lambda: p1(), {})
+    unbatched = _unbatched_program(p1)
+    for program in [batched, unbatched]:
+        assert (program.count("wget -O /tmp/mydirectory/both https://webserver.com/both.txt") == 1)
+        assert ("cat > /tmp/mydirectory/both" not in program)
+        assert ("cat > /tmp/absolute << 'ENDOFFILE'" in program)
+
+    import base64, io, tarfile
+    archives = [line for line in batched.split("\n") if line.startswith("echo ")]
+    assert (len(archives) == 1)
+    with tarfile.open(fileobj=io.BytesIO(base64.b64decode(archives[0].split(" ")[1]))) as tar:
+        assert (sorted(tar.getnames()) == sorted("file{}".format(k) for k in range(20)))
+
+
+
+def test_batch_commands_are_bounded():
+    """
+    we test that batch operations over many files split their commands,
+    so that no command exceeds the limit of the length of a shell argument
+    """
+    import base64, io, tarfile
+    from graphformation import executor
+
+    def p1():
+        mydir = directory(
+          resource_id="dir",
+          permissions="777",
+          location="/tmp/mydirectory"
+        )
+
+        for k in range(3000):
+            file(
+                resource_id="file{}".format(k),
+                filename="a_rather_long_file_name_{}".format(k),
+                parent=ref(mydir),
+                text="Lorem ipsum dolor {}".format(k)
+            )
+
+    def p2():
+        directory(
+          resource_id="dir",
+          permissions="777",
+          location="/tmp/mydirectory"
+        )
+
+    state0, _, exec0 = execute_change_program(lambda: p1(), {}, with_operations=True)
+    state1, _, exec1 = execute_change_program(lambda: p2(), state0, with_operations=True)
+    for operations, command_prefix in [(exec0, "echo "), (exec1, "rm -f ")]:
+        commands = operations[-1]["commands"]
+        assert (len(commands) > 1)
+        assert (all(command.startswith(command_prefix) for command in commands))
+        assert (all(len(command) <= executor.MAX_COMMAND_BYTES for command in commands))
+
+    names = []
+    for command in exec0[-1]["commands"]:
+        archive = base64.b64decode(command[len("echo "):].split(" ")[0])
+        with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+            for member in tar.getmembers():
+                assert (member.mode == 0o666 and member.mtime == 0)
+                names.append(member.name)
+    assert (len(names) == 3000)
+    assert (sum(len(command.split()) - 2 for command in exec1[-1]["commands"]) == 3000)
+
+def test_remove_directory_with_file():
+    """
+    we test deleting a file together with its directory. the path of the file
+    is resolved from the previous state
+    """
+    def p1():
+        mydir = directory(
+          resource_id="dir",
+          permissions="777",
+          location="/tmp/mydirectory/"
+        )
+
+        file(
+            resource_id="contentfile",
+            filename="file1",
+            parent=ref(mydir),
+            text="Lorem ipsum dolor"
+        )
+
+    def p2():
+        pass
+
+    state0, exec0 = execute_change_program(lambda: p1(), {})
+    state1, exec1 = execute_change_program(lambda: p2(), state0)
+
+    expected_exec1 = """
+# delete file contentfile
+rm -f /tmp/mydirectory/file1 
+# end
+
+
+# delete directory dir
+rm -fr /tmp/mydirectory/ 
+# end
+    """
+    assert (exec1.strip() == expected_exec1.strip())
@@ -0,0 +1,442 @@
+import base64
+import io
+import json
+import os
+import random
+import tarfile
+import tempfile
+import threading
+import time
+
+from graphformation import apply as gf_apply
+from graphformation import executor
+from graphformation import plan as gf_plan
+from graphformation import plan_cache as gf_plan_cache
+from graphformation import shards
+from graphformation import spec as gf_spec
+from graphformation import state_store
+from graphformation import watch
+from graphformation.spec import *
+
+"""
+We generate random pairs of programs and check that every planning engine
+produces a program equivalent to the reference, executor.execute without batching.
+
+p1(): a random program of directories, files and dummy_ref_resources
+p2(): p1 with random mutable and immutable property changes, re-pointed
+      references, deletions, additions, renamed ids and new resources which
+      take the location or the filename of a deleted resource
+
+Every program is run in a filesystem simulator. Starting from the filesystem
+of p1, the program of p2 must leave exactly the directories and files p2 defines.
+
+The reference planner does not re-create the files of a directory whose location
+changes, so the generator only moves directories without files.
+
+Besides planning, the plans are applied in parallel and planned in shards.
+"""
+
+
+DIRECTORY_PERMISSIONS = ["700", "755", "777"]
+
+
+class _Names:
+    def __init__(self):
+        self.count = 0
+
+    def next(self, prefix):
+        self.count += 1
+        return "{}{}".format(prefix, self.count)
+
+
+def _new_resource(rng, names, ids, directories):
+    kind = rng.choice(["directory", "file", "dummy_ref_resource"] if directories else
+                      ["directory", "dummy_ref_resource"])
+    if kind == "directory":
+        return {"id": names.next("dir"), "resource_type": kind,
+                "location": "/gf/" + names.next("loc"),
+                "permissions": rng.choice(DIRECTORY_PERMISSIONS)}
+    if kind == "file":
+        content = ("text", names.next("text ")) if rng.random() < 0.5 else \
+            ("source", "https://webserver.com/" + names.next("src"))
+        return {"id": names.next("file"), "resource_type": kind,
+                "parent": rng.choice(directories),
+                "filename": names.next("f"), content[0]: content[1]}
+    resource = {"id": names.next("dummy"), "resource_type": kind}
+    for prop in ["mutable_parent", "immutable_parent"]:
+        if ids and rng.random() < 0.6:
+            resource[prop] = rng.choice(ids)
+    return resource
+
+
+def _append(resource, resources, ids, directories):
+    resources.append(resource)
+    ids.append(resource["id"])
+    if resource["resource_type"] == "directory":
+        directories.append(resource["id"])
+
+
+def random_program(rng, names, size):
+    """
+    :return: a list of resource definitions, references only point to earlier resources
+    """
+    resources, ids, directories = [], [], []
+    for _ in range(size):
+        _append(_new_resource(rng, names, ids, directories), resources, ids, directories)
+    return resources
+
+
+def _kind(resource_id):
+    return resource_id.rstrip("0123456789")
+
+
+def _reuse_path(rng, names, deleted, renamed, directories):
+    # a new resource in the place of a deleted one, without a dependency between them
+    if deleted["resource_type"] == "directory":
+        return {"id": names.next("dir"), "resource_type": "directory",
+                "location": deleted["location"],
+                "permissions": rng.choice(DIRECTORY_PERMISSIONS)}
+    if deleted["resource_type"] != "file":
+        return None
+    parent = renamed.get(deleted["parent"], deleted["parent"])
+    if parent in directories:
+        return {"id": names.next("file"), "resource_type": "file", "parent": parent,
+                "filename": deleted["filename"], "text": names.next("text ")}
+    return None
+
+
+def mutate(rng, names, resources, rate=0.3):
+    """
+    :return: a changed copy of the program
+    """
+    result, ids, directories = [], [], []
+    defined = set()
+    deleted, renamed = [], {}
+    for resource in resources:
+        if rng.random() < rate / 3:
+            deleted.append(resource)
+            continue
+        resource = dict(resource)
+        for prop in ["parent", "mutable_parent", "immutable_parent"]:
+            if resource.get(prop) in renamed:
+                resource[prop] = renamed[resource[prop]]
+        if rng.random() < rate / 3:
+            # the same resource under a new id
+            renamed[resource["id"]] = names.next(_kind(resource["id"]))
+            resource["id"] = renamed[resource["id"]]
+        if rng.random() < rate:
+            if resource["resource_type"] == "directory":
+                resource[rng.choice(["location", "permissions"])] = None
+            elif resource["resource_type"] == "file":
+                resource[rng.choice(["parent", "filename", "content"])] = None
+            else:
+                resource[rng.choice(["mutable_parent", "immutable_parent"])] = None
+
+        if resource["resource_type"] == "directory":
+            if resource["location"] is None:
+                resource["location"] = "/gf/" + names.next("loc")
+            if resource["permissions"] is None:
+                resource["permissions"] = rng.choice(DIRECTORY_PERMISSIONS)
+        elif resource["resource_type"] == "file":
+            if resource["parent"] not in defined:
+                resource["parent"] = None
+            if not directories:
+                continue
+            if resource["parent"] is None:
+                resource["parent"] = rng.choice(directories)
+            if resource["filename"] is None:
+                resource["filename"] = names.next("f")
+            if resource.get("content", False) is None:
+                del resource["content"]
+                resource.pop("text", None)
+                resource.pop("source", None)
+                resource["source"] = "https://webserver.com/" + names.next("src")
+        else:
+            for prop in ["mutable_parent", "immutable_parent"]:
+                if prop in resource and (resource[prop] is None or resource[prop] not in defined):
+                    resource[prop] = rng.choice(ids) if ids and rng.random() < 0.7 else None
+                if resource.get(prop, 0) is None:
+                    del resource[prop]
+        _append(resource, result, ids, directories)
+        defined.add(resource["id"])
+
+    for resource in deleted:
+        reused = _reuse_path(rng, names, resource, renamed, directories)
+        if reused is not None and rng.random() < 0.5:
+            _append(reused, result, ids, directories)
+    for _ in range(int(len(resources) * rate / 3) + 1):
+        _append(_new_resource(rng, names, ids, directories), result, ids, directories)
+    return result
+
+
+def _keep_locations_of_directories_with_files(p1, p2):
+    old = {r["id"]: r for r in p1}
+    parents = set(r["parent"] for r in p1 + p2 if r["resource_type"] == "file")
+    for resource in p2:
+        if resource["resource_type"] == "directory" and resource["id"] in parents:
+            if resource["id"] in old and old[resource["id"]]["resource_type"] == "directory":
+                resource["location"] = old[resource["id"]]["location"]
+
+
+def random_program_pair(seed, size):
+    rng = random.Random(seed)
+    names = _Names()
+    p1 = random_program(rng, names, size)
+    p2 = mutate(rng, names, p1)
+    _keep_locations_of_directories_with_files(p1, p2)
+    # a location can only be taken once in a program
+    locations = set()
+    for resource in p2:
+        if resource["resource_type"] == "directory":
+            if resource["location"] in locations:
+                resource["location"] = "/gf/" + names.next("loc")
+            locations.add(resource["location"])
+    return p1, p2
+
+
+def as_program(resources):
+    def program():
+        defined = {}
+        for r in resources:
+            if r["resource_type"] == "directory":
+                obj = directory(resource_id=r["id"], location=r["location"], permissions=r["permissions"])
+            elif r["resource_type"] == "file":
+                obj = file(resource_id=r["id"], parent=ref(defined[r["parent"]]), filename=r["filename"],
+                           text=r.get("text"), source=r.get("source"))
+            else:
+                refs = {prop: ref(defined[r[prop]])
+                        for prop in ["mutable_parent", "immutable_parent"] if prop in r}
+                obj = dummy_ref_resource(resource_id=r["id"], **refs)
+            defined[r["id"]] = obj
+    return program
+
+
+def graph_of(resources):
+    save_graph = gf_spec.GRAPH
+    gf_spec.GRAPH = {}
+    try:
+        as_program(resources)()
+        return graph_repr()
+    finally:
+        gf_spec.GRAPH = save_graph
+
+
+class FileSystem:
+    """
+    A simulator of the commands emitted by the executor
+    """
+    def __init__(self):
+        self.directories = {}
+        self.files = {}
+        # commands run one at a time, operations applied in parallel interleave between them
+        self.lock = threading.Lock()
+
+    def copy(self):
+        fs = FileSystem()
+        fs.directories = dict(self.directories)
+        fs.files = dict(self.files)
+        return fs
+
+    def _parent_exists(self, path):
+        parent = os.path.dirname(path)
+        assert parent in self.directories, "no directory for {}".format(path)
+
+    def _remove_tree(self, path):
+        prefix = path.rstrip("/") + "/"
+        self.directories.pop(path, None)
+        for key in [key for key in self.directories if key.startswith(prefix)]:
+            del self.directories[key]
+        for key in [key for key in self.files if key.startswith(prefix)]:
+            del self.files[key]
+
+    def run(self, command):
+        with self.lock:
+            self._run(command)
+
+    def _run(self, command):
+        if command.startswith("cat > ") and command.endswith("\nENDOFFILE\n"):
+            header, body = command[len("cat > "):-len("\nENDOFFILE\n")].split("\n", 1)
+            path = header[:-len(" << 'ENDOFFILE'")]
+            self._parent_exists(path)
+            self.files[path] = body + "\n"
+        elif command.startswith(("echo create:", "echo update:", "echo delete:")):
+            pass
+        elif command.startswith("echo ") and " | base64 -d | tar -xz " in command:
+            archive, extract = command[len("echo "):].split(" | base64 -d | tar -xz ")
+            directory = extract.split(" -C ")[1]
+            assert directory in self.directories
+            with tarfile.open(fileobj=io.BytesIO(base64.b64decode(archive))) as tar:
+                for member in tar.getmembers():
+                    self.files[os.path.join(directory, member.name)] = \
+                        tar.extractfile(member).read().decode("utf-8")
+        elif command.startswith("mkdir -p "):
+            # stricter than the shell, so that a directory created before its old one
+            # is deleted shows up
+            for path in command.split()[2:]:
+                assert path not in self.directories, "{} exists".format(path)
+                self.directories[path] = None
+        elif command.startswith("rm -fr "):
+            for path in command.split()[2:]:
+                self._remove_tree(path)
+        elif command.startswith("rm -f "):
+            for path in command.split()[2:]:
+                self.files.pop(path, None)
+        elif command.startswith("chmod "):
+            _, permissions, path = command.split()
+            assert path in self.directories
+            self.directories[path] = permissions
+        elif command.startswith("wget -O "):
+            _, _, path, source = command.split()
+            self._parent_exists(path)
+            self.files[path] = "<" + source + ">"
+        else:
+            raise Exception("Unknown command: " + command)
+
+    def run_program(self, operations):
+        for operation in operations:
+            for command in operation["commands"]:
+                self.run(command)
+
+    def run_script(self, program):
+        # every operation is printed as a comment, its commands ending with " " and "# end"
+        for block in program.split("\n# end\n"):
+            block = block.strip("\n")
+            if "\n" in block:
+                for command in block.split("\n", 1)[1][:-1].split(" \n"):
+                    self.run(command)
+
+
+def expected_filesystem(graph):
+    directories = set()
+    files = {}
+    for resource in graph.values():
+        props = resource["properties"]
+        if resource["resource_type"] == "directory":
+            directories.add(props["location"])
+    for resource in graph.values():
+        props = resource["properties"]
+        if resource["resource_type"] == "file":
+            location = graph[props["parent"]["!ref"]]["properties"]["location"]
+            path = os.path.join(location, props["filename"])
+            files[path] = props["text"] + "\n" if "text" in props else "<" + props["source"] + ">"
+    return directories, files
+
+
+def _copy(obj):
+    return json.loads(json.dumps(obj))
+
+
+def _operations(old_state, graph, batch):
+    return executor.build_plan(_copy(old_state), _copy(graph), batch=batch).operations
+
+
+def reference_engine(old_state, graph):
+    return _operations(old_state, graph, batch=False)
+
+
+def batched_engine(old_state, graph):
+    return _operations(old_state, graph, batch=True)
+
+
+def saved_plan_engine(old_state, graph):
+    plan = executor.build_plan(_copy(old_state), _copy(graph), batch=False)
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "plan.gfp")
+        plan.write(filename)
+        with gf_plan.load(filename) as loaded:
+            return loaded.operations
+
+
+def cached_engine(old_state, graph):
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = gf_plan_cache.PlanCache(tmp)
+        executor.execute(_copy(old_state), _copy(graph), plan_cache=cache, batch=False)
+        _, program = executor.execute(_copy(old_state), _copy(graph), plan_cache=cache, batch=False)
+        key = gf_plan_cache.fingerprint(old_state, graph, batch=False)
+        operations = cache.get(key)["operations"]
+        assert(program == executor.execute(_copy(old_state), _copy(graph), batch=False)[1])
+        return operations
+
+
+def incremental_engine(old_state, graph):
+    # the program is first planned unchanged, then edited into graph
+    unchanged = {key: state_store.definition(resource) for key, resource in old_state.items()}
+    planner = watch.IncrementalPlanner(_copy(old_state))
+    planner.update(unchanged)
+    planner.update(_copy(graph))
+    return [op.json_repr() for op in planner.operations()]
+
+
+def parallel_apply_engine(old_state, graph, fs):
+    plan = executor.build_plan(_copy(old_state), _copy(graph), batch=False)
+    with tempfile.TemporaryDirectory() as tmp:
+        state_file = os.path.join(tmp, "state.json")
+        state_store.commit(state_file, {}, 0, old_state)
+
+        def run_command(command):
+            time.sleep(0) # lets the other workers run in between
+            fs.run(command)
+        gf_apply.apply_plan(plan, state_file, run_command=run_command, workers=8)
+        return state_store.read(state_file)[0]
+
+
+def sharded_engine(old_state, graph, fs):
+    # directories, files and dummy_ref_resources are separate shards, started from old_state
+    unchanged = {key: state_store.definition(resource) for key, resource in old_state.items()}
+    with tempfile.TemporaryDirectory() as tmp:
+        shards.execute(tmp, _copy(unchanged), _kind, processes=1)
+        for _, program in shards.execute(tmp, _copy(graph), _kind, processes=1):
+            fs.run_script(program)
+        state = {}
+        for shard_state, _ in shards.read_shards(tmp).values():
+            state.update(shard_state)
+        return state
+
+
+# engines which must emit exactly the operations of the reference
+EXACT_ENGINES = [saved_plan_engine, cached_engine, incremental_engine]
+# engines which may emit other operations with the same effect
+EQUIVALENT_ENGINES = [batched_engine]
+# engines which change the filesystem themselves and return the new state
+APPLY_ENGINES = [parallel_apply_engine, sharded_engine]
+
+
+def check_pair(p1, p2, engines):
+    graph1, graph2 = graph_of(p1), graph_of(p2)
+    state1, _ = executor.execute({}, _copy(graph1), batch=False)
+
+    fs1 = FileSystem()
+    fs1.run_program(reference_engine({}, graph1))
+    assert((set(fs1.directories), fs1.files) == expected_filesystem(graph1))
+
+    reference = reference_engine(state1, graph2)
+    reference_fs = fs1.copy()
+    reference_fs.run_program(reference)
+    assert((set(reference_fs.directories), reference_fs.files) == expected_filesystem(graph2))
+    reference_state, _ = executor.execute(_copy(state1), _copy(graph2), batch=False)
+
+    for engine in engines:
+        fs = fs1.copy()
+        if engine in APPLY_ENGINES:
+            assert(engine(state1, graph2, fs) == reference_state), engine.__name__
+        else:
+            operations = engine(state1, graph2)
+            if engine in EXACT_ENGINES:
+                assert(operations == reference), engine.__name__
+            fs.run_program(operations)
+        assert(fs.directories == reference_fs.directories), engine.__name__
+        assert(fs.files == reference_fs.files), engine.__name__
+
+
+def test_random_program_pairs():
+    for seed in range(200):
+        p1, p2 = random_program_pair(seed, size=20)
+        try:
+            check_pair(p1, p2, EXACT_ENGINES + EQUIVALENT_ENGINES + APPLY_ENGINES)
+        except AssertionError as e:
+            raise AssertionError("seed {}: {}".format(seed, e))
+
+
+def test_program_pair_at_scale():
+    p1, p2 = random_program_pair(seed=10000, size=10000)
+    check_pair(p1, p2, EQUIVALENT_ENGINES + [incremental_engine])
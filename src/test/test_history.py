@@ -0,0 +1,108 @@
+import os
+import tempfile
+
+from graphformation import executor
+from graphformation import history as gf_history
+from graphformation.spec import *
+
+"""
+We save consecutive states in the history and check that unchanged
+resources are stored once, and that we can load, diff and roll back versions
+"""
+
+
+def p1():
+    mydir = directory(
+        resource_id="dir",
+        permissions="777",
+        location="/tmp/mydirectory"
+    )
+    for k in range(10):
+        file(
+            resource_id="file{}".format(k),
+            filename="file{}".format(k),
+            parent=ref(mydir),
+            text="Lorem ipsum dolor"
+        )
+
+
+def p2():
+    mydir = directory(
+        resource_id="dir",
+        permissions="770",
+        location="/tmp/mydirectory"
+    )
+    for k in range(9):
+        file(
+            resource_id="file{}".format(k),
+            filename="file{}".format(k),
+            parent=ref(mydir),
+            text="Lorem ipsum dolor"
+        )
+
+
+def _objects(directory):
+    return sum(len(files) for _, _, files in os.walk(os.path.join(directory, "objects")))
+
+
+def test_versions_share_resources():
+    with tempfile.TemporaryDirectory() as tmp:
+        history = gf_history.History(tmp)
+        state0, _ = execute_change_program(p1, {})
+        state1, _ = execute_change_program(p2, state0)
+        v1 = history.save(state0)
+        objects = _objects(tmp)
+        v2 = history.save(state1)
+        # only the changed directory is stored again
+        assert(_objects(tmp) == objects + 1)
+        assert(history.versions() == [v1, v2])
+
+        reopened = gf_history.History(tmp)
+        assert(reopened.load(v1) == state0)
+        assert(reopened.load(v2) == state1)
+        assert(reopened.diff(v1, v2) == {"added": [], "removed": ["file9"], "changed": ["dir"]})
+
+
+def test_snapshots():
+    with tempfile.TemporaryDirectory() as tmp:
+        history = gf_history.History(tmp)
+        state = {}
+        for k in range(40):
+            state = dict(state, **{"d{}".format(k): {"id": "d{}".format(k), "resource_type": "directory",
+                                                     "properties": {"location": "/tmp/d", "permissions": "777"}}})
+            history.save(state)
+        assert(len(gf_history.History(tmp).load(40)) == 40)
+        assert(len(gf_history.History(tmp).load(33)) == 33)
+
+
+def test_rollback_plan():
+    with tempfile.TemporaryDirectory() as tmp:
+        history = gf_history.History(tmp)
+        state0, _ = execute_change_program(p1, {})
+        v1 = history.save(state0)
+        state1, _ = execute_change_program(p2, state0)
+        _, program = executor.execute(state1, history.rollback_graph(v1))
+        assert("chmod 777 /tmp/mydirectory" in program)
+        assert("# create file file9" in program)
+
+
+def test_concurrent_commits_save_every_version():
+    from concurrent.futures import ThreadPoolExecutor
+    from graphformation import state_store
+
+    with tempfile.TemporaryDirectory() as tmp:
+        state_file = os.path.join(tmp, "state.json")
+        history = gf_history.History(os.path.join(tmp, "history"))
+
+        def add(k):
+            resource_id = "r{}".format(k)
+            resource = {"id": resource_id, "resource_type": "directory",
+                        "properties": {"location": "/tmp/" + resource_id, "permissions": "777"}}
+            state_store.commit(state_file, {}, 0, {resource_id: resource},
+                               on_commit=lambda state, *_: history.save(state))
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(add, range(16)))
+        assert(history.versions() == list(range(1, 17)))
+        # every version adds one resource to the one before
+        assert([len(history.load(version)) for version in history.versions()] == list(range(1, 17)))
@@ -0,0 +1,128 @@
+import json
+import os
+import tempfile
+
+from graphformation import index as gf_index
+from graphformation import state_store
+from graphformation.spec import *
+
+"""
+We query the reference index of a state and check that it is kept
+up to date incrementally when the state changes
+"""
+
+
+def p1():
+    dir1 = directory(
+        resource_id="dir",
+        permissions="777",
+        location="/tmp/mydirectory"
+    )
+
+    contentfile = file(
+        resource_id="contentfile",
+        filename="file1",
+        parent=ref(dir1),
+        text="Lorem ipsum dolor"
+    )
+
+    dummy_ref_resource(
+        resource_id="resource1",
+        mutable_parent=ref(contentfile)
+    )
+
+
+def p2():
+    directory(
+        resource_id="dir",
+        permissions="777",
+        location="/tmp/mydirectory"
+    )
+
+    dir2 = directory(
+        resource_id="another_dir",
+        permissions="777",
+        location="/tmp/another_directory"
+    )
+
+    file(
+        resource_id="contentfile",
+        filename="file1",
+        parent=ref(dir2),
+        text="Lorem ipsum dolor"
+    )
+
+
+def test_queries():
+    state0, _ = execute_change_program(p1, {})
+    index = gf_index.GraphIndex.from_state(state0)
+    assert(index.dependents("dir") == {"contentfile"})
+    assert(index.dependents("dir", transitive=True) == {"contentfile", "resource1"})
+    assert(index.dependencies("resource1", transitive=True) == {"contentfile", "dir"})
+    assert(index.dependencies("dir") == set())
+
+
+def test_blast_radius():
+    state0, _ = execute_change_program(p1, {})
+    index = gf_index.GraphIndex.from_state(state0)
+    assert(index.blast_radius("dir", "permissions") ==
+           {"updated": ["dir"], "recreated": [], "affected": []})
+    assert(index.blast_radius("dir", "location") ==
+           {"updated": ["resource1"], "recreated": ["contentfile", "dir"],
+            "affected": ["contentfile", "resource1"]})
+    # files are always re-created by the executor
+    assert(index.blast_radius("contentfile", "filename") ==
+           {"updated": ["resource1"], "recreated": ["contentfile"], "affected": ["resource1"]})
+    assert(index.blast_radius("contentfile", "permissions")["recreated"] == ["contentfile"])
+
+
+def test_incremental_update():
+    state0, _ = execute_change_program(p1, {})
+    state1, _ = execute_change_program(p2, json.loads(json.dumps(state0)))
+    index = gf_index.GraphIndex.from_state(state0)
+    index.update(state1)
+    assert(index.json_repr() == gf_index.GraphIndex.from_state(state1).json_repr())
+    assert(index.dependents("dir") == set())
+    assert(index.dependents("another_dir") == {"contentfile"})
+
+
+def test_index_is_stored_with_the_state():
+    state0, _ = execute_change_program(p1, {})
+    with tempfile.TemporaryDirectory() as tmp:
+        state_file = os.path.join(tmp, "state.json")
+        state_store.commit(state_file, {}, 0, state0,
+                           on_commit=state_store.index_and_history(state_file))
+        index = state_store.load_index(state_file)
+        assert(index.dependents("contentfile") == {"resource1"})
+
+
+def test_stored_index_is_updated_incrementally():
+    state0, _ = execute_change_program(p1, {})
+    state1, _ = execute_change_program(p2, json.loads(json.dumps(state0)))
+    with tempfile.TemporaryDirectory() as tmp:
+        state_file = os.path.join(tmp, "state.json")
+        on_commit = state_store.index_and_history(state_file)
+        state_store.commit(state_file, {}, 0, state0, on_commit=on_commit)
+        state_store.commit(state_file, state0, 1, state1, on_commit=on_commit)
+        index = state_store.load_index(state_file)
+        assert(index.dependents("another_dir") == {"contentfile"})
+        assert(index.dependents("dir") == set())
+        # a commit without the index leaves it stale, it is built again when loaded
+        state_store.commit(state_file, state1, 2, state0)
+        index = state_store.load_index(state_file)
+        assert(index.dependents("dir") == {"contentfile"})
+        assert(index.dependents("another_dir") == set())
+
+
+def test_blast_radius_follows_immutable_references():
+    def p3():
+        dir1 = directory(resource_id="dir", permissions="777", location="/tmp/mydirectory")
+        fixed = dummy_ref_resource(resource_id="fixed", immutable_parent=ref(dir1))
+        dummy_ref_resource(resource_id="moving", mutable_parent=ref(fixed))
+
+    state, _ = execute_change_program(p3, {})
+    index = gf_index.GraphIndex.from_state(state)
+    assert(index.blast_radius("dir", "location") ==
+           {"updated": ["moving"], "recreated": ["dir", "fixed"], "affected": ["fixed", "moving"]})
+    assert(index.blast_radius("fixed", "mutable_parent") ==
+           {"updated": ["fixed"], "recreated": [], "affected": []})
@@ -0,0 +1,196 @@
+import json
+import os
+import tempfile
+
+from graphformation import spec
+from graphformation import apply as gf_apply
+from graphformation import checkpoint
+from graphformation import executor
+from graphformation import plan as gf_plan
+from graphformation import state_store
+from graphformation.spec import *
+
+"""
+We save a plan in the binary format, load it back and apply it
+against the state file it was computed against
+"""
+
+
+def _graph(program):
+    save_graph = spec.GRAPH
+    spec.GRAPH = {}
+    try:
+        program()
+        return graph_repr()
+    finally:
+        spec.GRAPH = save_graph
+
+
+def p1():
+    directory(
+        resource_id="dir",
+        permissions="777",
+        location="/tmp/mydirectory"
+    )
+
+
+def p2():
+    mydir = directory(
+        resource_id="dir",
+        permissions="770",
+        location="/tmp/mydirectory"
+    )
+
+    file(
+        resource_id="contentfile",
+        filename="file1",
+        parent=ref(mydir),
+        text="Lorem ipsum dolor"
+    )
+
+
+def _write_state(filename, state):
+    with open(filename, 'w') as f:
+        f.write(json.dumps(state))
+
+
+def test_plan_roundtrip():
+    state0, _ = execute_change_program(p1, {})
+    plan = executor.build_plan(state0, _graph(p2))
+    with tempfile.TemporaryDirectory() as tmp:
+        plan_file = os.path.join(tmp, "plan.gfp")
+        plan.write(plan_file)
+        with gf_plan.load(plan_file) as loaded:
+            assert(loaded.operations == plan.operations)
+            assert(list(loaded.edges) == list(plan.edges))
+            assert(loaded.state_hashes == plan.state_hashes)
+            assert(loaded.new_state == plan.new_state)
+            assert(loaded.program() == plan.program())
+
+
+def test_plan_edges():
+    state0, _ = execute_change_program(p1, {})
+    plan = executor.build_plan(state0, _graph(p2))
+    comments = [op["comment"] for op in plan.operations]
+    assert(comments == ["# create file contentfile", "# update directory dir"])
+    # the file does not wait for the chmod of its directory
+    assert(plan.dependencies() == {0: [], 1: []})
+
+
+def test_apply_plan():
+    state0, _ = execute_change_program(p1, {})
+    plan = executor.build_plan(json.loads(json.dumps(state0)), _graph(p2))
+    with tempfile.TemporaryDirectory() as tmp:
+        state_file = os.path.join(tmp, "state.json")
+        _write_state(state_file, state0)
+        commands = []
+        new_state = gf_apply.apply_plan(plan, state_file, run_command=commands.append)
+        assert(commands[-1] == "chmod 770 /tmp/mydirectory")
+        with open(state_file) as f:
+            assert(json.loads(f.read()) == new_state)
+
+
+def test_apply_refuses_changed_state():
+    state0, _ = execute_change_program(p1, {})
+    plan = executor.build_plan(json.loads(json.dumps(state0)), _graph(p2))
+    with tempfile.TemporaryDirectory() as tmp:
+        state_file = os.path.join(tmp, "state.json")
+        state0["dir"]["properties"]["permissions"] = "700"
+        _write_state(state_file, state0)
+        try:
+            gf_apply.apply_plan(plan, state_file, run_command=lambda cmd: None)
+            assert(False)
+        except Exception as e:
+            assert("has changed since the plan was created" in str(e))
+
+
+def test_apply_resumes_after_failure():
+    def p3():
+        mydir = directory(
+            resource_id="dir",
+            permissions="777",
+            location="/tmp/mydirectory"
+        )
+        for k in range(3):
+            file(
+                resource_id="file{}".format(k),
+                filename="file{}".format(k),
+                parent=ref(mydir),
+                source="https://webserver.com/file{}.txt".format(k)
+            )
+
+    # without batching every file is a separate operation
+    plan = executor.build_plan({}, _graph(p3), batch=False)
+    with tempfile.TemporaryDirectory() as tmp:
+        state_file = os.path.join(tmp, "state.json")
+
+        def fail_on_second_file(cmd):
+            if "file1" in cmd:
+                raise Exception("transient failure")
+        try:
+            gf_apply.apply_plan(plan, state_file, run_command=fail_on_second_file,
+                                checkpoint_batch_size=1)
+            assert(False)
+        except Exception as e:
+            assert(str(e) == "transient failure")
+        assert(not os.path.isfile(state_file))
+
+        commands = []
+        gf_apply.apply_plan(plan, state_file, run_command=commands.append)
+        failed_at = [op["resource_id"] for op in plan.operations].index("file1")
+        assert(len(commands) == len(plan.operations) - failed_at)
+        assert("file1" in commands[0])
+        assert(not os.path.isfile(state_file + ".journal"))
+        assert(os.path.isfile(state_file))
+
+
+def test_torn_journal_line_is_not_completed():
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "state.json.journal")
+        journal = checkpoint.Journal(filename, "plan", batch_size=1)
+        assert(journal.completed() == set())
+        journal.record(0)
+        journal.close()
+        # a crash while writing "12\n" left only "1"
+        with open(filename, 'a') as f:
+            f.write("1")
+
+        journal = checkpoint.Journal(filename, "plan", batch_size=1)
+        assert(journal.completed() == {0})
+        journal.record(5)
+        journal.close()
+        journal = checkpoint.Journal(filename, "plan")
+        assert(journal.completed() == {0, 5})
+        journal.close()
+
+
+def test_apply_plan_with_the_shell():
+    with tempfile.TemporaryDirectory() as tmp:
+        location = os.path.join(tmp, "dir")
+
+        def p4(permissions, texts):
+            mydir = directory(resource_id="dir", permissions=permissions, location=location)
+            for name, text in texts.items():
+                file(resource_id=name, filename=name, parent=ref(mydir), text=text)
+
+        state_file = os.path.join(tmp, "state.json")
+        texts = {"file{}".format(k): "$HOME {}".format(k) for k in range(20)}
+        plan = executor.build_plan({}, _graph(lambda: p4("700", texts)))
+        # the files are created together from an archive
+        assert("| tar -xz " in plan.program())
+        gf_apply.apply_plan(plan, state_file)
+        assert(sorted(os.listdir(location)) == sorted(texts))
+        with open(os.path.join(location, "file1")) as f:
+            assert(f.read() == "$HOME 1\n")
+
+        state, _ = state_store.read(state_file)
+        # the file is created from a here-document
+        plan = executor.build_plan(state, _graph(lambda: p4("750", {"c": "multiple\nlines"})))
+        gf_apply.apply_plan(plan, state_file)
+        assert(os.listdir(location) == ["c"])
+        with open(os.path.join(location, "c")) as f:
+            assert(f.read() == "multiple\nlines\n")
+        assert(oct(os.stat(location).st_mode & 0o777) == "0o750")
+        # nothing is left to resume
+        assert(not os.path.isfile(state_file + ".journal"))
+        assert(not os.path.isfile(state_store.reservations_filename(state_file)))
@@ -0,0 +1,76 @@
+import os
+import tempfile
+
+from graphformation.spec import *
+from graphformation import plan_cache
+from graphformation.plan_cache import PlanCache, fingerprint
+
+"""
+We check that running the same program against the same state twice
+returns the cached plan, and that the cache stays within its size cap
+"""
+
+
+def _program():
+    mydir = directory(
+        resource_id="dir",
+        permissions="777",
+        location="/tmp/mydirectory"
+    )
+
+    file(
+        resource_id="contentfile",
+        filename="file1",
+        parent=ref(mydir),
+        text="Lorem ipsum dolor"
+    )
+
+
+def test_cache_hit_returns_same_plan():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = PlanCache(cache_dir)
+        state0, exec0 = execute_change_program(_program, {}, plan_cache=cache)
+        assert(len(os.listdir(cache_dir)) == 1)
+
+        key = fingerprint({}, {})
+        assert(cache.get(key) is None)
+
+        state1, exec1 = execute_change_program(_program, {}, plan_cache=cache)
+        assert(exec1 == exec0)
+        assert(state1 == state0)
+
+
+def test_cache_hit_returns_operations():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = PlanCache(cache_dir)
+        _, _, missed = execute_change_program(_program, {}, plan_cache=cache, with_operations=True)
+        entry = cache.get(os.listdir(cache_dir)[0].split(".")[0])
+        comments = [op["comment"] for op in entry["operations"]]
+        assert(comments == ["# create directory dir", "# create file contentfile"])
+
+        _, _, hit = execute_change_program(_program, {}, plan_cache=cache, with_operations=True)
+        assert(hit == missed == entry["operations"])
+
+
+def test_key_depends_on_the_format_version():
+    key = fingerprint({}, {})
+    save_version = plan_cache.FORMAT_VERSION
+    plan_cache.FORMAT_VERSION += 1
+    try:
+        assert(fingerprint({}, {}) != key)
+    finally:
+        plan_cache.FORMAT_VERSION = save_version
+
+
+def test_cache_evicts_least_recently_used():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = PlanCache(cache_dir, max_entries=2)
+        cache.put("a", {"n": 1})
+        cache.put("b", {"n": 2})
+        os.utime(os.path.join(cache_dir, "a.plan.json"), (0, 0))
+        os.utime(os.path.join(cache_dir, "b.plan.json"), (1, 1))
+        cache.get("a")
+        cache.put("c", {"n": 3})
+        assert(cache.get("b") is None)
+        assert(cache.get("a") == {"n": 1})
+        assert(cache.get("c") == {"n": 3})
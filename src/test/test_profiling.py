@@ -0,0 +1,34 @@
+from graphformation.profiling import Profiler
+from graphformation.spec import *
+
+"""
+We profile planning a program and check that the report has a section per phase
+"""
+
+
+def test_profile_report():
+    def p1():
+        mydir = directory(
+            resource_id="dir",
+            permissions="777",
+            location="/tmp/mydirectory"
+        )
+        for k in range(10):
+            file(
+                resource_id="file{}".format(k),
+                filename="file{}".format(k),
+                parent=ref(mydir),
+                text="Lorem ipsum dolor"
+            )
+
+    profiler = Profiler(top=5)
+    execute_change_program(p1, {}, profiler=profiler)
+    assert([phase.name for phase in profiler.phases] ==
+           ["program", "graph_repr", "toposort", "diff", "emit"])
+
+    report = profiler.report()
+    assert("=== program (resources=11)" in report)
+    assert("=== graph_repr (resources=11)" in report)
+    assert("=== emit (old_resources=0, resources=11)" in report)
+    assert("hotspots by cumulative time:" in report)
+    assert("allocations by line:" in report)
@@ -0,0 +1,67 @@
+import os
+import tempfile
+
+from graphformation import program_cache
+
+"""
+We check that the graph of a program is evaluated once and then served
+from the cache until the program changes
+"""
+
+
+PROGRAM = """
+from graphformation.spec import directory
+
+with open({counter!r}, 'a') as f:
+    f.write("x")
+
+directory(
+    resource_id="dir",
+    permissions="{permissions}",
+    location="/tmp/mydirectory"
+)
+"""
+
+
+def _write_program(path, counter, permissions):
+    with open(path, 'w') as f:
+        f.write(PROGRAM.format(counter=counter, permissions=permissions))
+
+
+def _evaluations(counter):
+    with open(counter) as f:
+        return len(f.read())
+
+
+def test_program_is_evaluated_once():
+    with tempfile.TemporaryDirectory() as tmp:
+        program = os.path.join(tmp, "program.py")
+        counter = os.path.join(tmp, "counter")
+        cache_dir = os.path.join(tmp, "cache")
+        _write_program(program, counter, "777")
+
+        graph0 = program_cache.graph_repr(program, directory=cache_dir)
+        graph1 = program_cache.graph_repr(program, directory=cache_dir)
+        assert(graph0 == graph1)
+        assert(graph0["dir"]["properties"]["permissions"] == "777")
+        assert(_evaluations(counter) == 1)
+
+        # touching the program without changing it does not evaluate it again
+        os.utime(program, (0, 0))
+        program_cache.graph_repr(program, directory=cache_dir)
+        assert(_evaluations(counter) == 1)
+
+
+def test_changed_program_is_evaluated_again():
+    with tempfile.TemporaryDirectory() as tmp:
+        program = os.path.join(tmp, "program.py")
+        counter = os.path.join(tmp, "counter")
+        cache_dir = os.path.join(tmp, "cache")
+        _write_program(program, counter, "777")
+        program_cache.graph_repr(program, directory=cache_dir)
+
+        _write_program(program, counter, "770")
+        os.utime(program, (0, 0))
+        graph = program_cache.graph_repr(program, directory=cache_dir)
+        assert(graph["dir"]["properties"]["permissions"] == "770")
+        assert(_evaluations(counter) == 2)
@@ -0,0 +1,128 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+from graphformation import apply as gf_apply
+from graphformation import executor
+from graphformation import ratelimit
+from graphformation import state_store
+
+"""
+We apply plans in parallel and check that the dependencies, the rate limits
+and the concurrency caps are respected, and that the limits adapt to failures
+"""
+
+
+def _graph(dirs, files):
+    graph = {}
+    for d in range(dirs):
+        dir_id = "dir{}".format(d)
+        graph[dir_id] = {"id": dir_id, "resource_type": "directory",
+                         "properties": {"location": "/tmp/" + dir_id, "permissions": "777"}}
+        for f in range(files):
+            file_id = "file{}_{}".format(d, f)
+            graph[file_id] = {"id": file_id, "resource_type": "file",
+                              "properties": {"parent": {"!ref": dir_id}, "filename": file_id,
+                                             "source": "https://webserver.com/" + file_id}}
+    return graph
+
+
+def test_parallel_apply_respects_dependencies_and_caps():
+    plan = executor.build_plan({}, _graph(4, 3), batch=False)
+    lock = threading.Lock()
+    in_flight = {"file": 0, "max": 0}
+    started = []
+
+    def run_command(cmd):
+        with lock:
+            started.append(cmd)
+            if cmd.startswith("wget"):
+                in_flight["file"] += 1
+                in_flight["max"] = max(in_flight["max"], in_flight["file"])
+        time.sleep(0.01)
+        with lock:
+            if cmd.startswith("wget"):
+                in_flight["file"] -= 1
+
+    limiter = ratelimit.Limiter(type_limits={"file": ratelimit.Limit(concurrency=2)})
+    with tempfile.TemporaryDirectory() as tmp:
+        gf_apply.apply_plan(plan, os.path.join(tmp, "state.json"), run_command=run_command,
+                            workers=8, limiter=limiter)
+    assert(len(started) == 16)
+    assert(in_flight["max"] <= 2)
+    for d in range(4):
+        mkdir = started.index("mkdir -p /tmp/dir{}".format(d))
+        for f in range(3):
+            assert(started.index("wget -O /tmp/dir{d}/file{d}_{f} https://webserver.com/file{d}_{f}".
+                                 format(d=d, f=f)) > mkdir)
+
+
+def test_retries_with_backoff():
+    plan = executor.build_plan({}, _graph(1, 0))
+    attempts = []
+
+    def flaky(cmd):
+        attempts.append(cmd)
+        if len(attempts) < 3:
+            raise Exception("transient failure")
+
+    limit = ratelimit.Limit(rate=100, concurrency=4)
+    with tempfile.TemporaryDirectory() as tmp:
+        gf_apply.apply_plan(plan, os.path.join(tmp, "state.json"), run_command=flaky,
+                            limiter=ratelimit.Limiter(limit), retries=2, backoff=0.001)
+    assert(len(attempts) == 3)
+    # two failures halved the limits, one success grew them back a step
+    assert(limit.concurrency == 2)
+    assert(abs(limit.bucket.rate - 35.0) < 1e-6)
+
+
+def test_token_bucket_rate():
+    bucket = ratelimit.TokenBucket(rate=200, burst=1)
+    start = time.monotonic()
+    for _ in range(21):
+        bucket.acquire()
+    assert(time.monotonic() - start >= 0.09)
+
+
+
+def _renamed_graph(dir_id, file_id):
+    return {
+        dir_id: {"id": dir_id, "resource_type": "directory",
+                 "properties": {"location": "/tmp/x", "permissions": "777"}},
+        file_id: {"id": file_id, "resource_type": "file",
+                  "properties": {"parent": {"!ref": dir_id}, "filename": "f",
+                                 "source": "https://webserver.com/f"}}
+    }
+
+
+def test_parallel_apply_deletes_before_creating_renamed_resources():
+    old_state, _ = executor.execute({}, _renamed_graph("d1", "a"), batch=False)
+    for new_graph in [_renamed_graph("d1", "b"), _renamed_graph("d2", "b")]:
+        plan = executor.build_plan(json.loads(json.dumps(old_state)), new_graph, batch=False)
+        started = []
+
+        def run_command(cmd):
+            # the deletes are slow, so a create which does not wait for them runs first
+            if cmd.startswith("rm"):
+                time.sleep(0.05)
+            started.append(cmd)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            state_file = os.path.join(tmp, "state.json")
+            state_store.commit(state_file, {}, 0, old_state)
+            gf_apply.apply_plan(plan, state_file, run_command=run_command, workers=8)
+        deletes = [i for i, cmd in enumerate(started) if cmd.startswith("rm")]
+        creates = [i for i, cmd in enumerate(started) if not cmd.startswith("rm")]
+        assert(deletes and creates)
+        assert(max(deletes) < min(creates))
+
+
+def test_limits_must_be_positive():
+    for kwargs in [{"rate": 0}, {"rate": -1.0}, {"concurrency": 0}]:
+        try:
+            ratelimit.Limit(**kwargs)
+            assert(False)
+        except Exception as e:
+            assert("must be positive" in str(e))
@@ -0,0 +1,147 @@
+import os
+import tempfile
+
+from graphformation import spec
+from graphformation import shards
+from graphformation.spec import *
+
+"""
+We execute programs against a sharded state and check that only the
+shards touched by a change are planned
+"""
+
+
+def _execute(directory, program, shard_of=None):
+    save_graph = spec.GRAPH
+    spec.GRAPH = {}
+    try:
+        program()
+        return execute_sharded(directory, shard_of=shard_of, processes=1)
+    finally:
+        spec.GRAPH = save_graph
+
+
+def p1(web_permissions="777"):
+    with module("storage"):
+        data = directory(
+            resource_id="data",
+            permissions="777",
+            location="/tmp/data"
+        )
+
+    with module("web"):
+        directory(
+            resource_id="www",
+            permissions=web_permissions,
+            location="/tmp/www"
+        )
+        file(
+            resource_id="index",
+            filename="index.html",
+            parent=ref(data),
+            text="hello"
+        )
+
+
+def test_only_touched_shards_are_planned():
+    with tempfile.TemporaryDirectory() as tmp:
+        runs = _execute(tmp, p1)
+        assert([shard for shard, _ in runs] == ["storage", "web"])
+        # the file in the web shard is created in the directory of the storage shard
+        assert("cat > /tmp/data/index.html << 'ENDOFFILE'" in runs[1][1])
+
+        assert(_execute(tmp, p1) == [])
+
+        runs = _execute(tmp, lambda: p1(web_permissions="770"))
+        assert([shard for shard, _ in runs] == ["web"])
+        assert(runs[0][1].strip() == "# update directory www\nchmod 770 /tmp/www \n# end")
+
+
+def test_cross_shard_delete_uses_exports():
+    with tempfile.TemporaryDirectory() as tmp:
+        _execute(tmp, p1)
+        assert(sorted(shards._read_json(os.path.join(tmp, "exports.json"))) == ["data"])
+        runs = _execute(tmp, lambda: None)
+        # the file is deleted before the directory it is in
+        assert([shard for shard, _ in runs] == ["web", "storage"])
+        assert("rm -f /tmp/data/index.html" in runs[0][1])
+        assert(shards.read_shards(tmp) == {})
+        assert(not any(name.endswith(".shard.json") for name in os.listdir(tmp)))
+        assert(shards._read_json(os.path.join(tmp, "exports.json")) == {})
+
+        # a shard which is defined again continues from the generation it had
+        runs = _execute(tmp, p1)
+        assert([shard for shard, _ in runs] == ["storage", "web"])
+        assert(shards.read_shards(tmp)["web"][1] == 3)
+
+
+def test_programs_run_after_the_shards_they_reference():
+    def p3():
+        with module("web"):
+            www = directory(resource_id="www", location="/tmp/www")
+        with module("cache"):
+            file(resource_id="page", filename="page.html", parent=ref(www), text="hello")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        runs = _execute(tmp, p3)
+        assert([shard for shard, _ in runs] == ["web", "cache"])
+        runs = _execute(tmp, p1)
+        # the deletes of all shards run before the creates and updates
+        assert([shard for shard, _ in runs] == ["cache", "storage", "web"])
+        assert([program.split("\n")[0] for _, program in runs] ==
+               ["# delete file page", "# create directory data", "# create file index"])
+
+
+def test_resource_moves_between_shards():
+    def p5(shard):
+        with module(shard):
+            directory(resource_id="x", location="/tmp/x")
+        with module("a"):
+            directory(resource_id="y", location="/tmp/y")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _execute(tmp, lambda: p5("b"))
+        runs = _execute(tmp, lambda: p5("a"))
+        # the directory is deleted from its old shard before it is created in the new one
+        assert(runs == [("b", "# delete directory x\nrm -fr /tmp/x \n# end\n\n"),
+                        ("a", "# create directory x\nmkdir -p /tmp/x \n# end\n\n")])
+        assert(sorted(shards.read_shards(tmp)) == ["a"])
+
+
+def test_shards_which_reference_each_other_cannot_be_ordered():
+    def p4():
+        with module("a"):
+            a = directory(resource_id="a", location="/tmp/a")
+        with module("b"):
+            b = directory(resource_id="b", location="/tmp/b")
+            file(resource_id="b_file", filename="f", parent=ref(a), text="hello")
+        with module("a"):
+            file(resource_id="a_file", filename="f", parent=ref(b), text="hello")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            _execute(tmp, p4)
+            assert(False)
+        except Exception as e:
+            assert("The shards reference each other" in str(e))
+        assert(os.listdir(tmp) == [])
+
+
+def test_prefix_sharding_in_parallel():
+    def p2():
+        for team in ["a", "b", "c"]:
+            directory(
+                resource_id="{}.dir".format(team),
+                location="/tmp/{}".format(team)
+            )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        save_graph = spec.GRAPH
+        spec.GRAPH = {}
+        try:
+            p2()
+            runs = execute_sharded(tmp, shard_of=shards.by_prefix(), processes=2)
+        finally:
+            spec.GRAPH = save_graph
+        assert([shard for shard, _ in runs] == ["a", "b", "c"])
+        assert(sorted(shards.read_shards(tmp)) == ["a", "b", "c"])
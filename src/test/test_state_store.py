@@ -0,0 +1,126 @@
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from graphformation import apply as gf_apply
+from graphformation import executor
+from graphformation import state_store
+
+"""
+We simulate concurrent runs which read the same state and commit
+their changes one after the other
+"""
+
+
+def _dir(resource_id, permissions):
+    return {
+        "id": resource_id,
+        "resource_type": "directory",
+        "properties": {"location": "/tmp/" + resource_id, "permissions": permissions},
+        "status": "created"
+    }
+
+
+def _base(state_file):
+    state = {"a": _dir("a", "777"), "b": _dir("b", "777")}
+    state_store.commit(state_file, {}, 0, state)
+    return state_store.read(state_file)
+
+
+def test_generation_increases():
+    with tempfile.TemporaryDirectory() as tmp:
+        state_file = os.path.join(tmp, "state.json")
+        assert(state_store.read(state_file) == ({}, 0))
+        state, generation = _base(state_file)
+        assert(generation == 1)
+        assert(sorted(state) == ["a", "b"])
+
+
+def test_non_overlapping_changes_are_merged():
+    with tempfile.TemporaryDirectory() as tmp:
+        state_file = os.path.join(tmp, "state.json")
+        base, generation = _base(state_file)
+
+        first = dict(base, a=_dir("a", "700"))
+        second = dict(base, c=_dir("c", "777"))
+        del second["b"]
+        state_store.commit(state_file, base, generation, first)
+        merged, merged_generation = state_store.commit(state_file, base, generation, second)
+
+        assert(merged_generation == 3)
+        assert(sorted(merged) == ["a", "c"])
+        assert(merged["a"]["properties"]["permissions"] == "700")
+        assert(state_store.read(state_file) == (merged, 3))
+
+
+def test_overlapping_changes_conflict():
+    with tempfile.TemporaryDirectory() as tmp:
+        state_file = os.path.join(tmp, "state.json")
+        base, generation = _base(state_file)
+
+        state_store.commit(state_file, base, generation, dict(base, a=_dir("a", "700")))
+        try:
+            state_store.commit(state_file, base, generation, dict(base, a=_dir("a", "770")))
+            assert(False)
+        except state_store.ConflictError as e:
+            assert("The resources a have been changed by a concurrent run" in str(e))
+
+
+def test_concurrent_commits():
+    with tempfile.TemporaryDirectory() as tmp:
+        state_file = os.path.join(tmp, "state.json")
+        base, generation = _base(state_file)
+
+        def add(k):
+            resource_id = "r{}".format(k)
+            return state_store.commit(state_file, base, generation,
+                                      dict(base, **{resource_id: _dir(resource_id, "777")}))
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(add, range(32)))
+        state, generation = state_store.read(state_file)
+        assert(generation == 33)
+        assert(len(state) == 34)
+
+
+def _file(resource_id, parent):
+    return {
+        "id": resource_id,
+        "resource_type": "file",
+        "properties": {"parent": {"!ref": parent}, "filename": resource_id, "text": "hello"},
+        "status": "created"
+    }
+
+
+def test_changes_next_to_each_other_conflict():
+    d = _dir("d", "777")
+    # one run deletes the directory, the other adds a file to it
+    try:
+        state_store.merge({"d": d}, {}, {"d": d, "f": _file("f", "d")})
+        assert(False)
+    except state_store.ConflictError as e:
+        assert("d, f have been changed by a concurrent run" in str(e))
+
+
+def test_apply_reserves_resources_before_running_operations():
+    with tempfile.TemporaryDirectory() as tmp:
+        state_file = os.path.join(tmp, "state.json")
+        base, generation = _base(state_file)
+        plan = executor.build_plan(json.loads(json.dumps(base)), dict(base, a=_dir("a", "700")))
+        concurrent = []
+
+        def run_command(cmd):
+            # another run changes the same resource while the plan is being applied
+            try:
+                state_store.commit(state_file, base, generation, dict(base, a=_dir("a", "770")))
+            except state_store.ConflictError as e:
+                concurrent.append(str(e))
+
+        gf_apply.apply_plan(plan, state_file, run_command=run_command)
+        assert(len(concurrent) == 1 and "reserved by the unfinished apply" in concurrent[0])
+        state, generation = state_store.read(state_file)
+        assert(generation == 2)
+        assert(state["a"]["properties"]["permissions"] == "700")
+        # the reservation is released on commit
+        state_store.commit(state_file, state, generation, dict(state, b=_dir("b", "770")))
@@ -0,0 +1,119 @@
+import io
+import os
+import tempfile
+import threading
+import time
+
+from graphformation import executor
+from graphformation import program_cache
+from graphformation import state_store
+from graphformation import watch
+
+"""
+We edit a program step by step and check that the incremental plan
+only plans the changed resources again and stays equal to a full plan,
+and that changes of the watched files are detected
+"""
+
+
+PROGRAM = """
+from graphformation.spec import directory, file, ref
+
+d = directory(resource_id="dir", location="{location}", permissions="{permissions}")
+file(resource_id="file", parent=ref(d), filename="a.txt", text="hello")
+"""
+
+
+def _graph(location, permissions):
+    return {
+        "dir": {"id": "dir", "resource_type": "directory",
+                "properties": {"location": location, "permissions": permissions}},
+        "file": {"id": "file", "resource_type": "file",
+                 "properties": {"parent": {"!ref": "dir"}, "filename": "a.txt", "text": "hello"}}
+    }
+
+
+def _full_program(state, graph):
+    state = {key: dict(resource) for key, resource in state.items()}
+    graph = {key: dict(resource) for key, resource in graph.items()}
+    return executor.execute(state, graph, batch=False)[1]
+
+
+def test_incremental_plan():
+    state, _ = executor.execute({}, _graph("/tmp/x", "777"), batch=False)
+    planner = watch.IncrementalPlanner(state)
+
+    changed, added, dropped = planner.update(_graph("/tmp/x", "777"))
+    assert(changed == {"dir", "file"})
+    assert(added == [] and dropped == [])
+
+    changed, added, dropped = planner.update(_graph("/tmp/x", "700"))
+    assert(changed == {"dir"})
+    assert([op.commands for op in added] == [["chmod 700 /tmp/x"]])
+    assert(planner.program() == _full_program(state, _graph("/tmp/x", "700")))
+
+    graph = _graph("/tmp/x", "777")
+    del graph["file"]
+    changed, added, dropped = planner.update(graph)
+    assert(changed == {"dir", "file"})
+    assert([(op.op_type, op.commands) for op in added] == [("delete", ["rm -f /tmp/x/a.txt"])])
+    assert([op["commands"] for op in dropped] == [["chmod 700 /tmp/x"]])
+    assert(planner.program() == _full_program(state, graph))
+    assert(planner.summary() == {"deleted": 1, "created": 0, "modified": 0})
+
+
+def _write_program(path, location, permissions):
+    with open(path, 'w') as f:
+        f.write(PROGRAM.format(location=location, permissions=permissions))
+
+
+def test_session_prints_changed_operations():
+    with tempfile.TemporaryDirectory() as tmp:
+        program = os.path.join(tmp, "program.py")
+        state_file = os.path.join(tmp, "state.json")
+        _write_program(program, "/tmp/x", "777")
+        state_store.commit(state_file, {}, 0, program_cache.evaluate(program))
+        out = io.StringIO()
+        session = watch.Session(program, state_file, out)
+
+        session.replan()
+        assert("# 2 resources changed" in out.getvalue())
+        assert("# plan: 0 deleted, 0 created, 0 modified" in out.getvalue())
+
+        out.truncate(0)
+        _write_program(program, "/tmp/x", "700")
+        session.replan()
+        assert("# 1 resources changed" in out.getvalue())
+        assert("chmod 700 /tmp/x" in out.getvalue())
+        assert("# plan: 0 deleted, 0 created, 1 modified" in out.getvalue())
+
+        # a broken program keeps the last plan
+        out.truncate(0)
+        with open(program, 'w') as f:
+            f.write("directory(")
+        session.replan()
+        assert("SyntaxError" in out.getvalue())
+        assert(session.planner.summary()["modified"] == 1)
+
+
+def _check_watcher(watcher):
+    with tempfile.TemporaryDirectory() as tmp:
+        program = os.path.join(tmp, "program.py")
+        _write_program(program, "/tmp/x", "777")
+        watcher.watch([program])
+        assert(not watcher.wait(timeout=0.1))
+
+        def edit():
+            time.sleep(0.1)
+            _write_program(program, "/tmp/x", "700")
+
+        thread = threading.Thread(target=edit)
+        thread.start()
+        assert(watcher.wait(timeout=5))
+        thread.join()
+        watcher.close()
+
+
+def test_watchers_detect_changes():
+    _check_watcher(watch.watcher())
+    _check_watcher(watch._Polling(interval=0.01))